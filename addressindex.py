@@ -0,0 +1,54 @@
+class AddressIndex:
+    """ Remembers for every address which transactions of the chain it took
+    part in, so the history of an address doesn't require scanning the chain.
+
+    Attributes:
+        :locations (private): Address -> list of (block height, position in
+        block) of its transactions, oldest first.
+    """
+
+    def __init__(self):
+        self.__locations = {}
+
+    def apply_block(self, block):
+        """ Adds the transactions of a newly appended block to the index.
+
+        Arguments:
+            :block: The block that was appended to the chain.
+        """
+        for (position, tx) in enumerate(block.transactions):
+            location = (block.index, position)
+            # Reward transactions have no real sender
+            if tx.sender != 'MINING':
+                self.__locations.setdefault(tx.sender, []).append(location)
+            # Sending coins to yourself is listed once
+            if tx.recipient != tx.sender:
+                self.__locations.setdefault(tx.recipient, []).append(location)
+
+    def rebuild(self, chain):
+        """ Recalculates the index from scratch.
+
+        Arguments:
+            :chain: The blocks to index.
+        """
+        self.__locations = {}
+        for block in chain:
+            self.apply_block(block)
+
+    def count(self, address):
+        """ Returns the number of confirmed transactions of an address. """
+        return len(self.__locations.get(address, []))
+
+    def get_locations(self, address, start=0, limit=None):
+        """ Returns (block height, position in block) of the transactions of an
+        address, newest first.
+
+        Arguments:
+            :address: The address (public key) to look up.
+            :start: Number of (newer) transactions to skip.
+            :limit: Maximum number of locations to return, all if None.
+        """
+        locations = self.__locations.get(address, [])
+        end = len(locations) - max(start, 0)
+        begin = 0 if limit is None else max(end - limit, 0)
+        return locations[begin:max(end, 0)][::-1]
@@ -0,0 +1,155 @@
+""" Stress test for the locking of Blockchain, run the way a threaded server
+uses it: reader threads (balance, open transactions, streaming the chain,
+transaction lookups) run next to threads adding transactions, a thread mining
+blocks and a thread receiving blocks of another miner.
+
+Afterwards the state is checked: no thread failed, the chain is valid, every
+transaction is either open or confirmed (once), balances match a recount from
+the chain and a node loading the files from disk ends up with the same chain.
+The read throughput with one reader thread and with all reader threads is
+printed as well.
+
+Usage: python benchmarks/concurrency.py [seconds] [reader threads]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from blockchain import MINING_REWARD, Blockchain
+from transaction import Transaction
+from utility.hash_util import hash_transaction
+from utility.merkle import get_merkle_root
+from utility.verification import Verification
+from wallet import Wallet
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+READERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+SENDERS = 3
+# Seconds between blocks, short so the difficulty stays low while blocks are mined non-stop
+BLOCK_TIME = 0.01
+
+os.chdir(tempfile.mkdtemp())
+wallet = Wallet('stress')
+wallet.create_keys()
+blockchain = Blockchain(wallet.public_key, 'stress', block_time=BLOCK_TIME)
+# Funds for the senders
+for _ in range(20):
+    blockchain.mine_block()
+
+errors = []
+reads = [0] * READERS
+stop = threading.Event()
+
+
+def guarded(function):
+    def run(*args):
+        try:
+            while not stop.is_set():
+                function(*args)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            raise
+    return run
+
+
+def send(number):
+    recipient = 'recipient-{}'.format(random.randrange(10))
+    amount = random.choice([0.5, 1, 2])
+    nonce = '{}-{}'.format(number, random.getrandbits(64))
+    signature = wallet.sign_transaction(wallet.public_key, recipient, amount, nonce)
+    blockchain.add_transaction(recipient, wallet.public_key, signature, amount, nonce=nonce)
+    # No balance may ever be spent twice
+    assert blockchain.get_balance() >= 0, blockchain.get_balance()
+
+
+def mine():
+    blockchain.mine_block()
+    sleep(0.01)
+
+
+def receive():
+    # An empty block of another miner, it is rejected if our miner was faster
+    last = blockchain.get_tip()
+    reward = Transaction('MINING', 'other-miner', '', MINING_REWARD)
+    block = Block(last.index + 1, last.hash, [reward], 0, difficulty=blockchain.get_next_difficulty(),
+                  merkle_root=get_merkle_root([hash_transaction(reward)]))
+    while not Verification.valid_block_proof(block):
+        block.proof += 1
+    blockchain.add_block(block)
+    sleep(0.05)
+
+
+def read(number):
+    blockchain.get_balance()
+    blockchain.get_open_transactions()
+    blocks = list(blockchain.iter_blocks())
+    # Streamed blocks are a consecutive part of the chain
+    assert all(block.index == position for (position, block) in enumerate(blocks))
+    last = blockchain.get_tip()
+    if last.transactions:
+        found = blockchain.get_transaction(hash_transaction(last.transactions[0]))
+        assert last.transactions[0].sender == 'MINING' or found is not None
+    blockchain.get_headers(max(last.index - 10, 0), 10)
+    reads[number] += 1
+
+
+def measure_reads(threads):
+    """ Returns the number of read rounds per second reached with the given number of threads. """
+    stop.clear()
+    for number in range(READERS):
+        reads[number] = 0
+    workers = [threading.Thread(target=guarded(read), args=(number,)) for number in range(threads)]
+    start = perf_counter()
+    for worker in workers:
+        worker.start()
+    sleep(1)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(reads) / (perf_counter() - start)
+
+
+single = measure_reads(1)
+parallel = measure_reads(READERS)
+print('Reads alone: {:.0f}/s with 1 thread, {:.0f}/s with {} threads'.format(single, parallel, READERS))
+
+stop.clear()
+for number in range(READERS):
+    reads[number] = 0
+workers = ([threading.Thread(target=guarded(send), args=(number,)) for number in range(SENDERS)] +
+           [threading.Thread(target=guarded(mine)), threading.Thread(target=guarded(receive))] +
+           [threading.Thread(target=guarded(read), args=(number,)) for number in range(READERS)])
+start = perf_counter()
+for worker in workers:
+    worker.start()
+sleep(SECONDS)
+stop.set()
+for worker in workers:
+    worker.join()
+elapsed = perf_counter() - start
+
+chain = blockchain.chain
+open_transactions = blockchain.get_open_transactions()
+confirmed = [hash_transaction(tx) for block in chain for tx in block.transactions if tx.sender != 'MINING']
+print('{:.1f}s: {} blocks, {} confirmed and {} open transactions, {:.0f} reads/s while writing'.format(
+    elapsed, len(chain), len(confirmed), len(open_transactions), sum(reads) / elapsed))
+
+assert not errors, errors
+assert Verification.verify_chain(chain, block_time=BLOCK_TIME)
+assert len(confirmed) == len(set(confirmed)), 'transaction confirmed twice'
+assert not set(confirmed) & {hash_transaction(tx) for tx in open_transactions}, 'transaction open and confirmed'
+balance = sum(tx.amount for block in chain for tx in block.transactions if tx.recipient == wallet.public_key)
+balance -= sum(tx.get_total() for block in chain for tx in block.transactions if tx.sender == wallet.public_key)
+balance -= sum(tx.get_total() for tx in open_transactions)
+assert abs(blockchain.get_balance() - balance) < 1e-6, (blockchain.get_balance(), balance)
+reloaded = Blockchain(wallet.public_key, 'stress', block_time=BLOCK_TIME)
+assert reloaded.get_last_hash() == blockchain.get_last_hash()
+assert abs(reloaded.get_balance() - blockchain.get_balance()) < 1e-6
+print('Consistent')
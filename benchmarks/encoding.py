@@ -0,0 +1,66 @@
+""" Compares the size and the encode/decode throughput of the json format with
+the binary format of utility/codec.py.
+
+Builds a synthetic chain with random hex keys and signatures of the sizes
+Wallet produces (1024 bit RSA: 324 hex characters per DER public key, 256
+per signature) and serializes it the way the /chain endpoint does.
+
+Usage: python benchmarks/encoding.py [number of blocks]
+"""
+import json
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from transaction import Transaction
+from utility.codec import decode_blocks, encode_blocks
+
+BLOCKS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+PER_BLOCK = 20
+
+
+def random_hex(characters):
+    return os.urandom(characters // 2).hex()
+
+
+def build():
+    keys = [random_hex(324) for _ in range(50)]
+    chain = []
+    for index in range(BLOCKS):
+        transactions = [Transaction(keys[position % 50], keys[(position + 1) % 50], random_hex(256), 1.5)
+                        for position in range(PER_BLOCK - 1)]
+        # The mining reward
+        transactions.append(Transaction('MINING', keys[index % 50], '', 10))
+        chain.append(Block(index, random_hex(64), transactions, index, 1700000000.0 + index))
+    return chain
+
+
+def encode_json(chain):
+    return json.dumps([block.to_dict() for block in chain]).encode('utf8')
+
+
+def decode_json(data):
+    return [Block.from_dict(block) for block in json.loads(data)]
+
+
+def encode_binary(chain):
+    return b''.join(encode_blocks(chain))
+
+
+def timed(function, argument):
+    start = perf_counter()
+    result = function(argument)
+    return result, perf_counter() - start
+
+
+chain = build()
+print('{} blocks with {} transactions each'.format(BLOCKS, PER_BLOCK))
+for (name, encode, decode) in (('json', encode_json, decode_json), ('binary', encode_binary, decode_blocks)):
+    data, encode_seconds = timed(encode, chain)
+    decoded, decode_seconds = timed(decode, data)
+    assert [block.to_dict() for block in decoded] == [block.to_dict() for block in chain]
+    print('{:7} {:8.2f} MB ({:4.0f} bytes per transaction)  encode {:8.0f} blocks/s  decode {:8.0f} blocks/s'.format(
+        name, len(data) / 1000000, len(data) / (BLOCKS * PER_BLOCK), BLOCKS / encode_seconds, BLOCKS / decode_seconds))
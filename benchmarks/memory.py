@@ -0,0 +1,69 @@
+""" Compares the memory used per transaction by the slotted Block/Transaction
+classes with the __dict__ based classes they replaced.
+
+Builds a synthetic chain of 1M transactions (100 per block) with both
+representations and measures the allocated memory with tracemalloc. The key
+and signature strings are shared between all transactions so only the cost
+of the objects themselves is compared.
+
+Usage: python benchmarks/memory.py [number of transactions]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from transaction import Transaction
+
+TRANSACTIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+PER_BLOCK = 100
+
+SENDER = 'a' * 324
+RECIPIENT = 'b' * 324
+SIGNATURE = 'c' * 256
+
+
+class DictTransaction:
+    """ The previous layout of Transaction, attributes in a per-instance __dict__. """
+    def __init__(self, sender, recipient, signature, amount):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.signature = signature
+
+
+class DictBlock:
+    """ The previous layout of Block. """
+    def __init__(self, index, previous_hash, transactions, proof, timestamp):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.transactions = transactions
+        self.proof = proof
+
+
+def build(block_class, transaction_class):
+    chain = []
+    for index in range(TRANSACTIONS // PER_BLOCK):
+        transactions = [transaction_class(SENDER, RECIPIENT, SIGNATURE, float(index * PER_BLOCK + position))
+                        for position in range(PER_BLOCK)]
+        chain.append(block_class(index, SIGNATURE[:64], transactions, index, float(index)))
+    return chain
+
+
+def measure(block_class, transaction_class):
+    tracemalloc.start()
+    chain = build(block_class, transaction_class)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del chain
+    return used / TRANSACTIONS
+
+
+before = measure(DictBlock, DictTransaction)
+after = measure(Block, Transaction)
+print('{} transactions in {} blocks'.format(TRANSACTIONS, TRANSACTIONS // PER_BLOCK))
+print('__dict__ classes: {:.1f} bytes per transaction'.format(before))
+print('slotted classes:  {:.1f} bytes per transaction ({:.0%} of before)'.format(after, after / before))
@@ -0,0 +1,68 @@
+""" Measures the cost of the small reads a request handler does (last block,
+height, a single block, the open transactions) for chains of growing length.
+
+The accessors should cost the same no matter how long the chain is, copying
+the whole chain (what reading Blockchain.chain used to do) is timed once per
+chain length for comparison. Writes synthetic chains like startup.py.
+
+Usage: python benchmarks/reads.py [largest number of blocks]
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from blockchain import Blockchain
+from mempool import Mempool
+from storage import Storage
+from transaction import Transaction
+
+LARGEST = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+REPEAT = 10000
+
+
+def per_call(function):
+    """ Returns the average microseconds of a call of function. """
+    start = perf_counter()
+    for _ in range(REPEAT):
+        function()
+    return (perf_counter() - start) / REPEAT * 1000000
+
+
+def build(blocks):
+    node_id = 'reads-{}'.format(blocks)
+    storage = Storage(node_id)
+    storage.replace_blocks(Block(
+        index, '{:064x}'.format(index), [Transaction('MINING', 'miner', '', 10)], index, index, '{:064x}'.format(index + 1)
+    ) for index in range(blocks))
+    storage.save_state([], [], (blocks - 1, '{:064x}'.format(blocks)))
+    return Blockchain('miner', node_id)
+
+
+os.chdir(tempfile.mkdtemp())
+mempool = Mempool()
+for number in range(1000):
+    mempool.add(Transaction('sender', 'recipient', '{:0256x}'.format(number), 1))
+print('open transactions (1000): {:.2f} us'.format(per_call(mempool.get_transactions)))
+
+print('{:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>12}'.format(
+    'blocks', 'tip', 'height', 'block', 'chain[-1]', 'balance', 'full copy'))
+blocks = 1000
+while blocks <= LARGEST:
+    blockchain = build(blocks)
+    start = perf_counter()
+    blockchain.get_blocks(0, blocks)
+    copy = perf_counter() - start
+    print('{:>8} {:>7.2f}us {:>7.2f}us {:>7.2f}us {:>7.2f}us {:>7.2f}us {:>10.2f}ms'.format(
+        blocks,
+        per_call(blockchain.get_tip),
+        per_call(blockchain.get_height),
+        # One of the resident blocks, older ones are read from disk
+        per_call(lambda: blockchain.get_block(-50)),
+        per_call(lambda: blockchain.chain[-1]),
+        per_call(lambda: blockchain.get_balance('miner')),
+        copy * 1000))
+    blocks *= 10
@@ -0,0 +1,40 @@
+""" Measures how long a node needs to load a long chain from disk.
+
+Writes a synthetic chain (the proofs aren't valid, it is marked as verified so
+loading doesn't check them, like on every restart of a node) into a temporary
+directory and times the creation of a Blockchain object.
+Target: a 100k block chain loads in under 5 seconds.
+
+Usage: python benchmarks/startup.py [number of blocks]
+"""
+import os
+import resource
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from blockchain import Blockchain
+from storage import Storage
+from transaction import Transaction
+
+BLOCKS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+TARGET_SECONDS = 5
+
+os.chdir(tempfile.mkdtemp())
+storage = Storage('bench')
+storage.replace_blocks(Block(
+    index, '{:064x}'.format(index), [Transaction('MINING', 'miner', '', 10)], index, index, '{:064x}'.format(index + 1)
+) for index in range(BLOCKS))
+storage.save_state([], [], (BLOCKS - 1, '{:064x}'.format(BLOCKS)))
+
+start = perf_counter()
+blockchain = Blockchain('miner', 'bench')
+elapsed = perf_counter() - start
+# ru_maxrss is reported in kilobytes on Linux
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+print('Loaded {} blocks in {:.2f}s (target {}s), peak RSS {:.1f} MB'.format(
+    blockchain.get_height() + 1, elapsed, TARGET_SECONDS, peak))
@@ -0,0 +1,58 @@
+""" Compares chain verification in-process with verification spread over
+several worker processes (see ChainVerifier in utility/verification.py).
+
+Builds a synthetic chain with valid proofs and links, one block per second at
+a constant difficulty. The transactions have random keys and signatures of the
+sizes Wallet produces (signatures are not part of chain verification).
+
+Usage: python benchmarks/verification.py [number of blocks] [processes ...]
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import Block
+from difficulty import INITIAL_DIFFICULTY, get_target
+from transaction import Transaction
+from utility.hash_util import hash_block, hash_transaction
+from utility.merkle import get_merkle_root
+from utility.verification import Verification
+
+BLOCKS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+PROCESSES = [int(argument) for argument in sys.argv[2:]] or [1, 2, 4]
+PER_BLOCK = 20
+# Seconds between the synthetic blocks, the difficulty never changes
+BLOCK_TIME = 1
+
+
+def random_hex(characters):
+    return os.urandom(characters // 2).hex()
+
+
+def build():
+    keys = [random_hex(324) for _ in range(50)]
+    chain = [Block(0, '', [], 100, 0)]
+    for index in range(1, BLOCKS):
+        transactions = [Transaction(keys[position % 50], keys[(position + 1) % 50], random_hex(256), 1.5)
+                        for position in range(PER_BLOCK - 1)]
+        transactions.append(Transaction('MINING', keys[index % 50], '', 10))
+        block = Block(index, hash_block(chain[-1]), transactions, 0, 1700000000.0 + index * BLOCK_TIME,
+                      difficulty=INITIAL_DIFFICULTY,
+                      merkle_root=get_merkle_root([hash_transaction(tx) for tx in transactions]))
+        prepared = Verification.prepare_header(block)
+        while not Verification.valid_prepared_header(prepared, block.proof, get_target(INITIAL_DIFFICULTY)):
+            block.proof += 1
+        chain.append(block)
+    return chain
+
+
+chain = build()
+print('{} blocks with {} transactions each'.format(BLOCKS, PER_BLOCK))
+for processes in PROCESSES:
+    start = perf_counter()
+    invalid = Verification.find_invalid_block(chain, None, processes, BLOCK_TIME)
+    elapsed = perf_counter() - start
+    assert invalid is None, invalid
+    print('{} processes: {:.2f}s ({:.0f} blocks/s)'.format(processes, elapsed, BLOCKS / elapsed))
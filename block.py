@@ -1,5 +1,6 @@
 from time import time
 from utility.printable import Printable
+from transaction import Transaction
 
 class Block(Printable):
     """ A signle block of our blockchain.
@@ -10,12 +11,79 @@ class Block(Printable):
         :timestamp: The timestamp of the block
         :transactions: A list of transactions which are included in the block.
         :proof: The proof of work number that produced the block.
+        :hash: The hash of this block, set once the block is part of the chain.
+        After that the block can't be changed anymore.
+        :difficulty: Number of leading zero bits the proof hash needs (see
+        difficulty.py), None for blocks of older versions.
+        :merkle_root: Merkle root of the ids of the transactions (see
+        utility/merkle.py), None for blocks of older versions. The hash and
+        the proof of work of a block with a Merkle root only cover its header.
     """
 
+    # Fixed attributes instead of a per-instance __dict__, a long chain holds a lot of blocks
+    __slots__ = ('index', 'previous_hash', 'timestamp', 'transactions', 'proof', 'hash', 'difficulty',
+                 'merkle_root')
+
     # Constructor
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None):
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, hash=None, difficulty=None,
+                 merkle_root=None):
         self.index = index
         self.previous_hash = previous_hash
         self.timestamp = time() if timestamp is None else timestamp
         self.transactions = transactions
         self.proof = proof
+        self.difficulty = difficulty
+        self.merkle_root = merkle_root
+        # Set last, the block can't be changed once it has a hash
+        self.hash = hash
+
+    def __setattr__(self, name, value):
+        # The stored hash would no longer match the content of the block
+        if getattr(self, 'hash', None) is not None:
+            raise AttributeError('A block can not be changed once it is part of the chain.')
+        super().__setattr__(name, value)
+
+    def __reduce__(self):
+        # Pickle (e.g. for the verification pool) through the constructor, setting
+        # the attributes one by one would trip the check above
+        return (Block, (self.index, self.previous_hash, self.transactions, 
+                        self.proof, self.timestamp, self.hash, self.difficulty, self.merkle_root))
+
+    def header(self):
+        """ Returns everything but the transactions as dictionary. """
+        return {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'proof': self.proof,
+            'difficulty': self.difficulty,
+            'merkle_root': self.merkle_root,
+            'hash': self.hash
+        }
+
+    def to_dict(self):
+        """ Returns the block (and its transactions) as dictionary that can be dumped using json. """
+        block = self.header()
+        block['transactions'] = [tx.to_dict() for tx in self.transactions]
+        return block
+
+    @staticmethod
+    def from_dict(block, block_hash=None):
+        """ Creates a block (and its transactions) from a dictionary.
+
+        Arguments:
+            :block: The block dictionary, e.g. received from a peer.
+            :block_hash: The known hash of the block. Only pass it for blocks we
+            hashed ourselves, a hash received from a peer can't be trusted.
+        """
+        return Block(
+            block['index'], 
+            block['previous_hash'], 
+            [Transaction.from_dict(tx) for tx in block['transactions']],
+            block['proof'],
+            block['timestamp'],
+            block_hash,
+            # Blocks of older versions don't have a difficulty or a Merkle root
+            block.get('difficulty'),
+            block.get('merkle_root')
+        )
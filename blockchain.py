@@ -1,18 +1,39 @@
-from functools import reduce
-import hashlib as hl
-import json
-import requests
+import threading
+from collections import deque
+from time import time
 
 # Imports from our hash_util.py file. 
-from utility.hash_util import hash_block 
-from utility.verification import Verification
+from utility.codec import MIMETYPE, decode_blocks
+from utility.hash_util import hash_block, hash_transaction
+from utility.merkle import get_merkle_proof, get_merkle_root
+from utility.rwlock import ReadWriteLock
+from utility.verification import ChainVerifier, Verification
 
+from addressindex import AddressIndex
 from block import Block
+from blocktemplate import MAX_BLOCK_BYTES, MAX_BLOCK_TRANSACTIONS, build_template
+from broadcast import get_broadcaster
+from chainview import ChainView
+from difficulty import (BLOCK_TIME, RETARGET_INTERVAL, get_min_timestamp, get_target, next_difficulty,
+                        valid_difficulty, valid_timestamp)
+from ledger import Ledger
+from mempool import MEMPOOL_SIZE, Mempool
+from miner import CHECK_INTERVAL, parallel_proof_of_work
+from storage import LazyChain, Storage
 from transaction import Transaction
-from wallet import Wallet
+from txindex import TransactionIndex
 
 # The mining reward (reward for creating new block)
 MINING_REWARD = 10
+# (connect, read) timeout in seconds for downloading a peer's chain
+CHAIN_TIMEOUT = (2, 60)
+# Number of headers / blocks requested from a peer at once while syncing
+HEADER_BATCH = 500
+BLOCK_BATCH = 100
+# Number of blocks read at once (holding the read lock) while the chain is streamed
+ITER_BATCH = 100
+# Ask peers for blocks in the binary format, peers without support answer in json
+BINARY_HEADERS = {'Accept': '{}, application/json;q=0.5'.format(MIMETYPE)}
 
 print(__name__)
 
@@ -21,18 +42,56 @@ class Blockchain:
     managing the node which it is running on.
 
     Attributes:
-        :chain: The list of block.
-        :open_transactions (private): The list of open transactions.
+        :chain: Read-only view of the blocks (only the most recent blocks are kept in memory).
+        :open_transactions (private): The open transactions, indexed by transaction id.
+        :ledger (private): Running balances of all addresses.
+        :txindex (private): Block height and position of every confirmed transaction.
+        :addresses (private): Block height and position of the transactions of every address.
+        :verified (private): (height, hash) of the last block up to which the chain was
+        verified, blocks before it are trusted when loading and resolving.
         :hosting_node: The connected node
+        :mining_processes: Number of processes used for the proof of work search.
+        :verify_processes: Number of processes used to verify transaction signatures.
+        :mempool_size: Maximum number of open transactions.
+        :max_block_transactions: Maximum number of open transactions put into a mined block.
+        :max_block_bytes: Maximum size (binary format) of the open transactions in a mined block.
+        :block_time: Targeted number of seconds between two blocks, the difficulty is adjusted to it.
+        :hash_rate: Hashes per second reached while mining the current block (updated
+        during the search) or the last one.
     """
 
-    def __init__(self, public_key, node_id):
+    def __init__(self, public_key, node_id, mining_processes=1, verify_processes=1, mempool_size=MEMPOOL_SIZE,
+                 max_block_transactions=MAX_BLOCK_TRANSACTIONS, max_block_bytes=MAX_BLOCK_BYTES,
+                 block_time=BLOCK_TIME):
+        # The node handles requests in several threads and may mine in the background.
+        # The chain and everything derived from it (ledger, indexes, stored blocks)
+        # can be read by many threads at once, changing it takes the write lock.
+        self.__lock = ReadWriteLock()
+        # Guards the open transactions, their pending amounts and the peer nodes (the
+        # state file). If both are needed the chain lock is always taken first.
+        self.__state_lock = threading.RLock()
+        # Incremented whenever the chain or the open transactions change, a running
+        # proof of work search is given up when it changes
+        self.__revision = 0
+        # Files the chain, open transactions and peers of this node are stored in
+        self.__storage = Storage(node_id)
         # Creating the gensis block by creating a Block object
         genesis_block = Block(0, '', [], 100, 0)
-        # Initializing our (empty) blockchain list
+        # Initializing our (empty) blockchain, older blocks are paged in from storage
+        self.__chain = LazyChain(self.__storage)
+        # Index from block hash to the index of the block in the chain
+        self.__heights = {}
         self.chain = [genesis_block]
-        # Initializing our list of pending transactions (is a private attribute)
-        self.__open_transactions = []
+        # The genesis block is the same for every node, there is nothing to verify
+        self.__verified = (0, genesis_block.hash)
+        # Initializing our pool of pending transactions (is a private attribute)
+        self.__open_transactions = Mempool(mempool_size)
+        # Balance index which is kept up to date as blocks and transactions are added
+        self.__ledger = Ledger()
+        # Where every confirmed transaction is, used to reject replayed transactions
+        self.__txindex = TransactionIndex(node_id)
+        # History of every address, so it can be listed without scanning the chain
+        self.__addresses = AddressIndex()
         # Set hosting_node id
         self.public_key = public_key
         # Create a set because it can only hold unique values
@@ -41,6 +100,18 @@ class Blockchain:
         self.node_id = node_id
         # Switch to see if we need to resolve any conflicts
         self.resolve_conflicts = False
+        # More than one process spreads the proof of work search over several cores
+        self.mining_processes = mining_processes
+        self.hash_rate = None
+        # More than one process spreads signature checks of large batches over several cores
+        self.verify_processes = verify_processes
+        # Limits of the blocks we mine, open transactions which don't fit wait for the next block
+        self.max_block_transactions = max_block_transactions
+        self.max_block_bytes = max_block_bytes
+        # Has to be the same on every node, blocks with a different difficulty are rejected
+        self.block_time = block_time
+        # Sends transactions and blocks to the peer nodes in the background
+        self.__broadcaster = get_broadcaster()
         # Load any saved data from txt file
         self.load_data()
 
@@ -48,105 +119,220 @@ class Blockchain:
     # and a setter (@chain.setter)
     @property
     def chain(self):
-        return self.__chain[:]
+        # A view instead of a copy, reading a few blocks doesn't page in the whole chain
+        with self.__lock.read():
+            return ChainView(self, len(self.__chain))
 
     # Setter for chain property
     @chain.setter
     def chain(self, val):
-        self.__chain = val
+        with self.__lock.write():
+            for block in val:
+                self.__seal(block)
+            self.__chain.replace(val)
+            self.__heights = {block.hash: block.index for block in val}
+            self.__revision += 1
+
+    def get_revision(self):
+        """ Returns a number which changes whenever the chain or the open transactions change. """
+        return self.__revision
 
     def get_open_transactions(self):
-        """ Returns a copy of the open transaction list. """
-        return self.__open_transactions[:]
+        """ Returns a read-only snapshot (tuple) of the open transactions, oldest first. """
+        with self.__state_lock:
+            return self.__open_transactions.get_transactions()
 
     def load_data(self):
-        """ Initialize blockchain = open transactions data from file. """
-        try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='r') as f:
-                file_content = f.readlines()
-                # Tells the function to use globally defined variables do not create new local ones
-                global blockchain
-                global open_transactions
-                # Use json lib to convert the json string back into python object
-                # being sure to grab everything except the '\n' char using range selector [:-1]
-                # json.loads deserielizes a string in json format and gives back a python obj
-                blockchain = json.loads(file_content[0][:-1])
-                updated_blockchain = []
-                # IMPORTANT when we call valid_proof() we convert the list of transactions to 
-                #           a string and this adds '[OrderedDict()]' at the start of that list
-                #           therefor we must loop through the blockchain read in from file and 
-                #           adjust transactions to be an ordered dict using a list comp in the 
-                #           transactions portion
-                # Loop to create block objects for each block in our saved file
-                for block in blockchain:
-                    converted_tx = [Transaction(
-                        tx['sender'], 
-                        tx['recipient'], 
-                        tx['signature'], 
-                        tx['amount']) for tx in block['transactions']]
-                    updated_block = Block(
-                        block['index'], 
-                        block['previous_hash'], 
-                        converted_tx,
-                        block['proof'],
-                        block['timestamp']
-                    )
-                    # Append the newly updated block to our updated blockchain list
-                    updated_blockchain.append(updated_block)
-
-                # Update the entire blockchain
-                self.chain = updated_blockchain
-
-                # Use json lib to convert the json string back into python object
-                # json.loads deserielizes a string in json format and gives back a python obj
-                open_transactions = json.loads(file_content[1][:-1])
-                updated_transactions = []
-                # IMPORTANT open_transactions will be unordered dict therefore we must convert
-                #           newly read in open_transactions to an OrderedDict
+        """ Initialize blockchain + open transactions data from the storage files.
+
+        Blocks are streamed from the segment file one at a time, only their
+        headers and the most recent blocks are kept in memory. Balances are
+        calculated in the same pass. Blocks after the last verified block
+        (e.g. written by an older version) are verified while loading, spread
+        over the verify processes. Invalid blocks are dropped together with
+        the blocks after them, they are synced from peers again.
+        """
+        with self.__lock.write(), self.__state_lock:
+            try:
+                # Repair the files in case the node crashed in the middle of a write
+                self.__storage.recover()
+                loaded_chain = LazyChain(self.__storage)
+                loaded_heights = {}
+                self.__ledger.rebuild([], [])
+                self.__addresses.rebuild([])
+                self.__txindex.load()
+                open_transactions, peer_nodes, checkpoint = self.__storage.load_state()
+                # Blocks up to the last verified block are trusted, as long as it is still part of the chain
+                trusted = 0
+                if checkpoint is not None and checkpoint[0] < len(self.__storage):
+                    if self.__seal(self.__storage.read_block(checkpoint[0])).hash == checkpoint[1]:
+                        trusted = checkpoint[0]
+                verifier = None
+                # The difficulty of the blocks after the trusted block depends on the timestamps before it
+                timestamps = deque(maxlen=RETARGET_INTERVAL)
+                for converted_block in self.__storage.read_blocks():
+                    # Newer blocks are verified by the pool while loading goes on
+                    if converted_block.index == trusted:
+                        verifier = ChainVerifier(
+                            converted_block, trusted, self.verify_processes, timestamps, self.block_time)
+                    elif verifier is not None:
+                        verifier.add(converted_block)
+                    else:
+                        timestamps.append(converted_block.timestamp)
+                    # Blocks stored by older versions don't have their hash stored yet
+                    self.__seal(converted_block)
+                    self.__ledger.apply_block(converted_block)
+                    self.__addresses.apply_block(converted_block)
+                    # Blocks written right before a crash (or by older versions) aren't indexed yet
+                    if converted_block.index >= len(self.__txindex):
+                        self.__txindex.add_block(converted_block)
+                    loaded_chain.load(converted_block)
+                    loaded_heights[converted_block.hash] = converted_block.index
+                self.__txindex.truncate(len(loaded_chain))
+                invalid = verifier.get_first_invalid() if verifier is not None else None
+                if invalid is not None:
+                    print('Stored block {} is invalid, dropping it and the blocks after it'.format(invalid))
+                    self.__txindex.truncate(invalid)
+                    self.__storage.truncate(invalid)
+                    # Peers are asked for the dropped blocks
+                    self.resolve_conflicts = True
+                    return self.load_data()
+
+                if len(loaded_chain) > 0:
+                    # Update the entire blockchain
+                    self.__chain = loaded_chain
+                    self.__heights = loaded_heights
+                    self.__verified = (len(loaded_chain) - 1, loaded_chain.header(len(loaded_chain) - 1)['hash'])
+                else:
+                    # Fresh node, the genesis block is the first record of the segment
+                    self.__storage.append_block(self.__chain[0])
+                    self.__txindex.add_block(self.__chain[0])
+                    self.__ledger.rebuild(self.__chain, [])
+                    self.__addresses.rebuild(self.__chain)
+
+                # Convert the stored dictionaries back to transaction objects
+                self.__open_transactions.clear()
                 for tx in open_transactions:
-                    # Losing the ordering but we will fix when needed
-                    updated_transaction = Transaction(
-                        tx['sender'], 
-                        tx['recipient'], 
-                        tx['signature'], 
-                        tx['amount']
-                    )
-                    # Append the newly updated transaction to our updated transactions list
-                    updated_transactions.append(updated_transaction)
-                # Update the entire list of open_transactions now that they have been converted to an OrderedDict
-                self.__open_transactions = updated_transactions
-                peer_nodes = json.loads(file_content[2])
+                    tx = Transaction.from_dict(tx)
+                    # The state file might not have been saved after the last block was added
+                    if hash_transaction(tx) not in self.__txindex:
+                        self.__add_open_transaction(tx)
                 self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError): 
-            print('Handled exception...')
+            except (IOError, IndexError, ValueError): 
+                print('Handled exception...')
+                # Balances have to match whatever chain we ended up with
+                self.__ledger.rebuild(self.__chain, self.__open_transactions)
+                self.__addresses.rebuild(self.__chain)
 
 
     def save_data(self):
-        """ Save blockchain + open_transactions snapshot to a file """
+        """ Save the open transactions + peer nodes to the state file. Blocks are
+        written when they are appended (see store_block()).
+        """
+        with self.__state_lock:
+            try:
+                saveable_tx = [tx.to_dict() for tx in self.__open_transactions]
+                self.__storage.save_state(saveable_tx, list(self.__peer_nodes), self.__verified)
+            except IOError:
+                print('Saving failed!')
+
+
+    def store_block(self, block):
+        """ Append a single block to the block segment file and the transaction index.
+
+        Arguments:
+            :block: The block that was just added to the chain.
+        """
         try:
-            """Writes our blockchain and open transactions to a txt file in json format"""
-            with open('blockchain-{}.txt'.format(self.node_id), mode='w') as f:
-                # Create a list of dictionaries based on our block objects to dump using json and convert each transaction in a block to an dictionary
-                saveable_chain = [block.__dict__ for block in [Block(block_el.index, block_el.previous_hash, [tx.__dict__ for tx in block_el.transactions], block_el.proof, block_el.timestamp) for block_el in self.__chain]]
-                f.write(json.dumps(saveable_chain))
-                f.write('\n')
-                saveable_tx = [tx.__dict__ for tx in self.__open_transactions]
-                f.write(json.dumps(saveable_tx))
-                f.write('\n')
-                f.write(json.dumps(list(self.__peer_nodes)))
+            self.__storage.append_block(block)
+            # Written after the block, the index must never be ahead of the chain
+            self.__txindex.add_block(block)
         except IOError:
             print('Saving failed!')
 
 
-    def proof_of_work(self):
-        """Increments the proof of work number until a valid proof is found"""
-        # Grabs the last block in the blockchain
-        last_block = self.__chain[-1]
-        last_hash = hash_block(last_block)
-        proof = 0
-        # Try different PoW numbers and return the first valid one
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
-            proof += 1
+    def close(self):
+        """ Sends the queued broadcasts and forces the appended blocks which are
+        only synced in batches (see storage.FSYNC_BATCH) to disk, called when
+        the node shuts down.
+        """
+        # Without holding a lock, the responses of the peers are handled by our callbacks
+        self.__broadcaster.flush()
+        with self.__lock.write():
+            try:
+                self.__storage.sync()
+            except IOError:
+                print('Saving failed!')
+
+
+    @staticmethod
+    def __seal(block):
+        """ Calculate and store the hash of a block which becomes part of the chain,
+        from then on the block can't be changed.
+        """
+        if block.hash is None:
+            block.hash = hash_block(block)
+        return block
+
+
+    def __append_block(self, block):
+        """ Append a new block to the chain, the hash index, the ledger and the
+        storage. The caller holds the write lock.
+
+        Arguments:
+            :block: The verified block that should be appended.
+        """
+        self.__seal(block)
+        self.__chain.append(block)
+        self.__heights[block.hash] = block.index
+        self.__ledger.apply_block(block)
+        self.__addresses.apply_block(block)
+        self.store_block(block)
+        # Blocks are verified before they are appended, the verified part of the chain grows
+        if self.__verified[0] == block.index - 1:
+            self.__verified = (block.index, block.hash)
+        self.__revision += 1
+
+
+    def proof_of_work(self, block, should_stop=None):
+        """Increments the proof of work number until a valid proof is found
+
+        Arguments:
+            :block: The new block, everything but its proof is set (including the
+            Merkle root of its transactions).
+            :should_stop: Called regularly, if it returns True the search is given
+            up and None is returned.
+        """
+        start = time()
+
+        def on_progress(hashes):
+            elapsed = time() - start
+            if hashes and elapsed > 0:
+                self.hash_rate = hashes / elapsed
+
+        if self.mining_processes > 1:
+            proof, hashes = parallel_proof_of_work(block, self.mining_processes, should_stop, on_progress)
+        else:
+            # The header without the proof is the same for every guess, only hash it once
+            prepared = Verification.prepare_header(block)
+            target = get_target(block.difficulty)
+            proof = None
+            guess = 0
+            # Try different PoW numbers until a valid one is found
+            while proof is None:
+                if Verification.valid_prepared_header(prepared, guess, target):
+                    proof = guess
+                # Checking after every guess would slow the search down
+                elif guess % CHECK_INTERVAL == 0:
+                    on_progress(guess)
+                    if should_stop is not None and should_stop():
+                        break
+                guess += 1
+            hashes = guess
+        elapsed = time() - start
+        self.hash_rate = hashes / elapsed if elapsed > 0 else None
+        if self.hash_rate is not None and proof is not None:
+            print('Found proof after {} hashes ({:.0f} hashes/s)'.format(hashes, self.hash_rate))
         return proof
 
 
@@ -165,37 +351,183 @@ class Blockchain:
         else:
             participant = sender
 
-        # Use nested list comprehensions to obtain a list of transaction amounts
-        # if the sender is a participant, the second list comp is used to go through
-        # each block in the blockchain.
-        # This is a list of transaction amounts that are currently in the blockchain
-        # for the given participant.
-        tx_sender = [[tx.amount for tx in block.transactions
-            if tx.sender == participant] for block in self.__chain]
-        # Use nested list comprehension to get a list of transaction amounts that are
-        # currently in open_transactions for the participant
-        open_tx_sender = [tx.amount for tx in self.__open_transactions 
-            if tx.sender == participant]
-        tx_sender.append(open_tx_sender)
-        # Use reduce to sum list of open transactions down to one value
-        amount_sent = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0, tx_sender, 0)
-        # This fetches received coin amounts of transactions that were already in
-        # the blockchain
-
-        # We ignore open transactions here because you shouldn't be able to spend
-        # coin that is tied up in open transactions
-        tx_recipient = [[tx.amount for tx in block.transactions   
-            if tx.recipient == participant] for block in self.__chain]
-        # Use reduce to sum list of open transactions down to one value
-        amount_received = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0, tx_recipient, 0)
-        return amount_received - amount_sent
+        # The ledger already holds received - sent for everything in the chain
+        # and subtracts amounts tied up in open transactions. Coins received in
+        # open transactions are ignored because you shouldn't be able to spend
+        # coin that isn't confirmed yet.
+        with self.__lock.read():
+            return self.__ledger.get_balance(participant)
+
+
+    def get_headers(self, start, limit):
+        """ Returns the headers (block without transactions, plus its hash) of
+        up to limit blocks starting at index start.
+
+        Arguments:
+            :start: Index of the first block.
+            :limit: Maximum number of headers to return.
+        """
+        start = max(start, 0)
+        with self.__lock.read():
+            return [self.__chain.header(index).copy()
+                    for index in range(start, min(start + max(limit, 0), len(self.__chain)))]
+
+
+    def get_blocks(self, start, limit):
+        """ Returns up to limit blocks starting at index start. """
+        start = max(start, 0)
+        with self.__lock.read():
+            return self.__chain[start:min(start + max(limit, 0), len(self.__chain))]
+
+
+    def iter_blocks(self, start=0, limit=None):
+        """ Yields up to limit (default: all) blocks starting at index start
+        without copying the chain.
+
+        The blocks are the ones of the chain at the time of the call, blocks
+        added later are not included. The read lock is only held while a batch
+        of blocks is read, so a slow download doesn't hold up new blocks. If
+        the blocks are replaced by a fork in the meantime, the iteration stops.
+        """
+        start = max(start, 0)
+        with self.__lock.read():
+            stop = len(self.__chain) if limit is None else min(start + limit, len(self.__chain))
+            last_hash = self.__hash_at(stop - 1) if stop > start else None
+        return self.__iter_snapshot(start, stop, last_hash)
+
+
+    def __iter_snapshot(self, start, stop, last_hash):
+        """ Yields the blocks from index start up to (excluding) stop as long as
+        the block before stop still has the hash last_hash.
+        """
+        for position in range(start, stop, ITER_BATCH):
+            with self.__lock.read():
+                if len(self.__chain) < stop or self.__hash_at(stop - 1) != last_hash:
+                    print('Chain changed while it was streamed, stopping at block {}'.format(position))
+                    return
+                blocks = list(self.__chain.iter_range(position, min(position + ITER_BATCH, stop)))
+            for block in blocks:
+                yield block
+
+
+    def get_last_hash(self):
+        """ Returns the hash of the last block of the chain. """
+        with self.__lock.read():
+            return self.__hash_at(len(self.__chain) - 1)
+
+
+    def __hash_at(self, index):
+        """ Returns the hash of the block at index, it is part of the block header
+        so no block has to be paged in and hashed. The caller holds the chain lock.
+        """
+        return self.__chain.header(index)['hash']
+
+
+    def get_block_by_hash(self, block_hash):
+        """ Returns the block with the given hash or None if it isn't part of our chain. """
+        with self.__lock.read():
+            index = self.__heights.get(block_hash)
+            if index is None:
+                return None
+            return self.__chain[index]
+
+
+    def get_transaction(self, txid):
+        """ Returns (transaction, block height) of a confirmed transaction,
+        (transaction, None) of an open one or None if the transaction is unknown.
+
+        Arguments:
+            :txid: The id of the transaction (see hash_transaction()).
+        """
+        with self.__lock.read():
+            location = self.__txindex.get_location(txid)
+            if location is not None:
+                height, position = location
+                return self.__chain[height].transactions[position], height
+            with self.__state_lock:
+                transaction = self.__open_transactions.get(txid)
+            if transaction is not None:
+                return transaction, None
+            return None
+
+
+    def get_merkle_proof(self, txid):
+        """ Returns (header of its block, Merkle proof) of a confirmed transaction
+        (see utility/merkle.py), None if the transaction isn't confirmed or its
+        block was mined by an older version without a Merkle root.
+
+        Arguments:
+            :txid: The id of the transaction (see hash_transaction()).
+        """
+        with self.__lock.read():
+            location = self.__txindex.get_location(txid)
+            if location is None:
+                return None
+            height, position = location
+            block = self.__chain[height]
+        if block.merkle_root is None:
+            return None
+        return block.header(), get_merkle_proof([hash_transaction(tx) for tx in block.transactions], position)
+
+
+    def get_address_history(self, address, start=0, limit=None):
+        """ Returns the number of confirmed transactions of an address and a
+        page of them (newest first) as list of (transaction, block height, position).
+
+        Arguments:
+            :address: The address (public key) to look up.
+            :start: Number of (newer) transactions to skip.
+            :limit: Maximum number of transactions to return, all if None.
+        """
+        with self.__lock.read():
+            history = [(self.__chain[height].transactions[position], height, position)
+                       for (height, position) in self.__addresses.get_locations(address, start, limit)]
+            return self.__addresses.count(address), history
+
+
+    def get_tip(self):
+        """ Returns the last block of the chain. """
+        with self.__lock.read():
+            return self.__chain[-1]
+
+
+    def get_height(self):
+        """ Returns the index of the last block of the chain. """
+        with self.__lock.read():
+            return len(self.__chain) - 1
+
+
+    def get_block(self, index):
+        """ Returns a single block, older blocks are paged in from disk.
+
+        Arguments:
+            :index: Index of the block, negative values count from the end.
+        """
+        with self.__lock.read():
+            return self.__chain[index]
+
+
+    def get_next_difficulty(self):
+        """ Returns the difficulty the block following our last block must have. """
+        with self.__lock.read():
+            height = len(self.__chain)
+            return next_difficulty(
+                height, self.__chain.header(height - 1)['difficulty'], self.__get_timestamps(height), self.block_time)
+
+
+    def __get_timestamps(self, height):
+        """ Returns the timestamps the difficulty of the block at a height depends
+        on (of the blocks before it), oldest first. The caller holds the read lock.
+
+        Arguments:
+            :height: The index of the block.
+        """
+        return [self.__chain.header(index)['timestamp'] for index in range(max(height - RETARGET_INTERVAL, 0), height)]
 
 
     def get_last_blockchain_value(self):
         """" Returns the last value of the current blockchain. """
-        if len(self.__chain) < 1:
-            return None
-        return self.__chain[-1]
+        return self.get_tip()
 
 
 
@@ -204,192 +536,572 @@ class Blockchain:
                         sender, 
                         signature, 
                         amount = 1.0, 
-                        is_receiving = False):
+                        is_receiving = False,
+                        nonce = None,
+                        fee = 0):
         """ Append a new value as well as the last blockchain value to the blockchain list
 
         Arguments:
             :sender: The sender of the coins
             :recipient: The recipient of the coins
             :amount: The amount of coins sent (default of 1.0)
+            :nonce: The random value signed along with the transaction
+            :fee: The amount paid to the miner on top of amount (default of 0)
         """
-
+        if not Verification.valid_amount(amount) or not Verification.valid_fee(fee):
+            return False
         # Create new transaction object
-        transaction = Transaction(sender, recipient, signature, amount)
-        # Verify transaction
-        if Verification.verify_transaction(transaction, self.get_balance):
+        transaction = Transaction(sender, recipient, signature, amount, nonce, fee)
+        # Checking the signature is the expensive part, it doesn't need any lock
+        if not Verification.verify_transaction(transaction, self.get_balance, False):
+            return False
+        with self.__lock.read(), self.__state_lock:
+            # A transaction we already know (e.g. broadcast back to us) is not added twice
+            # and a confirmed transaction can't be replayed
+            if transaction in self.__open_transactions or hash_transaction(transaction) in self.__txindex:
+                return False
+            # Checking and reserving the balance under the state lock makes sure two
+            # transactions of the same sender can't spend the same coins
+            if not Verification.verify_transaction(transaction, self.get_balance):
+                return False
             # If successful append to open transactions
-            self.__open_transactions.append(transaction)
-            # Add anyone included in the transaction to the set of participants
-            # remember that sets are unique
+            self.__add_open_transaction(transaction)
             self.save_data()
-            if not is_receiving:
-                # Loop through each node in our node set
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-transaction'.format(node)
-                    try:
-                        response = requests.post(url, 
-                                                 json={
-                                                    'sender': sender, 
-                                                    'recipient': recipient, 
-                                                    'amount': amount, 
-                                                    'signature': signature
-                                                 })
-                        if (response.status_code == 400 or 
-                            response.status_code == 500):
-                            print('Transaction declined, needs resolving')
-                            return False
-                    # If we cant find that specific node, continue to the next node
-                    except requests.exceptions.ConnectionError:
-                        continue
-            return True
-        return False
+        if not is_receiving:
+            # Queue the transaction for all peer nodes, the transaction is accepted
+            # locally and we don't wait for the peers to answer
+            self.__broadcaster.broadcast(
+                self.get_peer_nodes(), 
+                'broadcast-transaction', 
+                transaction.to_dict(), 
+                self.__on_transaction_response)
+        return True
 
 
-    def mine_block(self):
-        """ Create a new block and add open transactions to it. """
+    def mine_block(self, should_stop=None):
+        """ Create a new block and add open transactions to it.
+
+        No lock is held during the proof of work search, so blocks and
+        transactions can be received in the meantime. If the chain moved on
+        while searching, the new block is dropped.
+
+        Arguments:
+            :should_stop: Called regularly during the proof of work search, if
+            it returns True the search is given up and no block is mined.
+        """
         if self.public_key == None:
             return None
-        # Fetch the currently last block of the blockchain
-        last_block = self.__chain[-1]
-        # Hash the list block
-        hashed_block = hash_block(last_block)
-        # Get the NONCE that uses the outstanding transactions and the previous
-        # block that leads to a valid hash
-        proof = self.proof_of_work()
-
-        # Create reward transaction using OrderedDict which uses a list of tuples
-        # to create ('key', value) pairs. Pass in a empty string for the signature
-        # since we never verify it using a signature
-        reward_transaction = Transaction('MINING', self.public_key, '', MINING_REWARD)
-
-        # Copy transaction instead of manupulating the original open_transactions
-        # This ensures that if for some reason the mining should fail, we don't
-        # have a reward sitting in the open transaction
-        copied_transactions = self.__open_transactions[:]
-        # Verify all transactions before appending the reward transaction
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
-                return None
+        with self.__lock.read():
+            # Fetch the hash of the currently last block of the blockchain
+            hashed_block = self.get_last_hash()
+            height = len(self.__chain)
+            difficulty = self.get_next_difficulty()
+            # Even if our clock is behind, the block has to be newer than the median of our last blocks
+            timestamp = max(time(), get_min_timestamp(self.__get_timestamps(height)))
+            with self.__state_lock:
+                open_transactions = self.__open_transactions.get_transactions()
+            # Pick the open transactions paying the highest fees that fit into the block,
+            # invalid ones are skipped and the rest stays open for the next block
+            copied_transactions, rejected = build_template(
+                open_transactions,
+                self.__ledger.get_confirmed_balance,
+                lambda tx: hash_transaction(tx) in self.__txindex,
+                self.max_block_transactions,
+                self.max_block_bytes,
+                self.verify_processes)
+            if rejected:
+                print('Dropping {} invalid open transactions'.format(len(rejected)))
+                with self.__state_lock:
+                    self.__remove_open(rejected)
+        # Create reward transaction, the miner also receives the fees. Pass in a
+        # empty string for the signature since we never verify it using a signature
+        reward_transaction = Transaction(
+            'MINING', self.public_key, '', MINING_REWARD + sum(tx.fee for tx in copied_transactions))
+        # The template is a new list, the reward doesn't end up in the open transactions
         copied_transactions.append(reward_transaction)
-
-        # Creating new block object
-        # Proof is the NONCE that leads to a valid hash of the newly created block
-        # that it's in.
+        # Creating new block object, the reward is part of the Merkle root the proof of work covers
         block = Block(
-            len(self.__chain), 
+            height, 
             hashed_block, 
             copied_transactions, 
-            proof
+            0,
+            timestamp=timestamp,
+            difficulty=difficulty,
+            merkle_root=get_merkle_root([hash_transaction(tx) for tx in copied_transactions])
         )
-        # Add the newly created block to the blockchain
-        self.__chain.append(block)
-        # Update open transactions to be emtpy
-        self.__open_transactions = []
-        self.save_data()
+        # Get the NONCE that leads to a valid hash of the header of the new block
+        proof = self.proof_of_work(block, should_stop)
+        if proof is None:
+            return None
+        block.proof = proof
+
+        with self.__lock.write():
+            # Another block was added while we were searching, the proof is worthless now
+            if self.get_last_hash() != hashed_block:
+                return None
+            # Add the newly created block to the blockchain
+            self.__append_block(block)
+            with self.__state_lock:
+                # Only the picked transactions leave the open transactions
+                self.__remove_open(block.transactions)
+                self.save_data()
 
         # Now broadcast to peer nodes
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-            converted_block = block.__dict__.copy()
-            # Convert block object to dictionary
-            converted_block['transactions'] = [tx.__dict__ for tx in converted_block['transactions']]
-            try:
-                response = requests.post(url, json = {'block': converted_block})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined, needs resolving')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                continue
+        # Convert block object to dictionary
+        converted_block = block.to_dict()
+        self.__broadcaster.broadcast(
+            self.get_peer_nodes(), 'broadcast-block', {'block': converted_block}, self.__on_block_response)
         return block
 
 
+    def __on_transaction_response(self, node, response):
+        """ Called by the broadcaster for every peer that answered a transaction broadcast. """
+        if response.status_code == 400 or response.status_code == 500:
+            print('Transaction declined by {}, needs resolving'.format(node))
+
+
+    def __on_block_response(self, node, response):
+        """ Called by the broadcaster for every peer that answered a block broadcast. """
+        if response.status_code == 400 or response.status_code == 500:
+            print('Block declined by {}, needs resolving'.format(node))
+        if response.status_code == 409:
+            self.resolve_conflicts = True
+
+
     def add_block(self, block):
         """ Add a block which was received via broadcasting to the 
         local blockchain.
+
+        Everything that only depends on the block itself (proof, signatures) is
+        checked before the write lock is taken, so readers aren't blocked by it.
+
+        Arguments:
+            :block: The received block, decoded without the hash sent along by
+            the peer (it is calculated by us).
         """
-        # Extract transaction data from received block and create a list of these transactions
-        transactions = [Transaction(
-            tx['sender'], 
-            tx['recipient'], 
-            tx['signature'], 
-            tx['amount']) for tx in block['transactions']]
-        # Check to see if transaction data form receieved block in valid
-        # Use 'transactions[:-1]' to grab every transaction except for the last one to make sure the reward
-        # transaction is not included since it wasn't part of calculating the proof of work.
-        proof_is_valid = Verification.valid_proof(
-            transactions[:-1], block['previous_hash'], block['proof'])
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
+        # Extract transaction data from received block
+        transactions = block.transactions
+        # Check to see if the header of the receieved block is valid, the proof of work of
+        # blocks of older versions covers every transaction but the reward instead
+        proof_is_valid = Verification.valid_block_proof(block)
+        # Checked again once we hold the write lock, a block that doesn't fit isn't worth verifying
+        hashes_match = self.get_last_hash() == block.previous_hash
         if not proof_is_valid or not hashes_match:
             return False
-        # Safe to add block if passes all checks
-        # Convert block from dictionary to a new block object
-        converted_block = Block(
-            block['index'], 
-            block['previous_hash'], 
-            transactions, 
-            block['proof'], 
-            block['timestamp'])
-        # Append the block to local blockchain
-        self.__chain.append(converted_block)
-        # Update open transactions
-        # Create a copy of the open transactions on the node
-        stored_transactions = self.__open_transactions[:]
-        # For every incoming transaction check to see if it is a part of local open transactions
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                # Checking all variables of local transactions are equal to transactions, if so then it is the same transaction
-                if opentx.sender == (itx['sender'] and 
-                        opentx.recipient == itx['recipient'] and 
-                        opentx.amount == itx['amount'] and 
-                        opentx.signature == itx['signature']):
-                    try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed.')
+        txids = self.__check_transactions(block)
+        if txids is None:
+            return False
+        with self.__lock.write():
+            # Another block might have been added in the meantime
+            if self.get_last_hash() != block.previous_hash:
+                return False
+            height = len(self.__chain)
+            # Requests are handled in parallel, only checked here the index is sure to be the next one
+            if block.index != height:
+                return False
+            # A block of an older version can't follow one with a Merkle root
+            if block.merkle_root is None and self.__chain.header(height - 1)['merkle_root'] is not None:
+                return False
+            timestamps = self.__get_timestamps(height)
+            # The timestamp can't be older than our last blocks or lie far in the future
+            if not valid_timestamp(block.timestamp, timestamps, time()):
+                return False
+            # The difficulty has to follow from the timestamps of our last blocks
+            if not valid_difficulty(block.difficulty, height, self.__chain.header(height - 1)['difficulty'],
+                                    timestamps, self.block_time):
+                return False
+            # Reject transactions which are already confirmed
+            if any(txid in self.__txindex for txid in txids):
+                return False
+            # Safe to add block if passes all checks
+            # Append the block to local blockchain
+            self.__append_block(block)
+            with self.__state_lock:
+                # Update open transactions
+                self.__remove_open(transactions)
+                self.save_data()
+            return True
 
-        self.save_data()
+
+    def __check_transactions(self, block):
+        """ Checks the transactions of a block as far as they don't depend on our
+        chain, returns the ids of its transactions without the reward or None if
+        the block is invalid. No lock is needed.
+
+        Arguments:
+            :block: The block to check.
+        """
+        transactions = block.transactions
+        # Every block ends with its reward
+        if not transactions:
+            return None
+        # The header has to match the transactions sent along
+        txids = [hash_transaction(tx) for tx in transactions]
+        if not Verification.valid_merkle_root(block, txids):
+            return None
+        reward = transactions[-1]
+        transactions = transactions[:-1]
+        # Coins can only be created by the reward
+        if any(tx.sender == 'MINING' for tx in transactions):
+            return None
+        # A negative amount or fee would take coins from the recipient or the miner instead of the sender
+        if not all(Verification.valid_amount(tx.amount) and Verification.valid_fee(tx.fee) for tx in transactions):
+            return None
+        # The reward isn't signed and pays exactly the mining reward and the fees
+        # (summed up the same way as in mine_block())
+        if (reward.sender != 'MINING' or reward.signature != '' or reward.fee
+                or reward.amount != MINING_REWARD + sum(tx.fee for tx in transactions)):
+            return None
+        # Reject transactions which appear twice in the block
+        txids = txids[:-1]
+        if len(set(txids)) < len(txids):
+            return None
+        # Check the signatures of every transaction except the reward transaction, blocks of
+        # older versions may contain transactions signed the old way
+        if not all(Verification.verify_transactions(
+                transactions, self.verify_processes, block.merkle_root is None)):
+            return None
+        return txids
+
+    def __remove_open(self, transactions):
+        """ Removes transactions which made it into a block (or turned out to be
+        invalid) from the open transactions. The caller holds the state lock.
+
+        Arguments:
+            :transactions: The transactions to remove.
+        """
+        # Transactions are looked up by id, the reward transaction simply isn't found
+        for tx in self.__open_transactions.remove(transactions):
+            self.__ledger.remove_pending(tx)
+
+
+    def __add_open_transaction(self, transaction):
+        """ Adds a verified transaction to the open transactions and reserves its
+        amount. The caller holds the state lock.
+
+        Arguments:
+            :transaction: The new open transaction.
+        """
+        evicted = self.__open_transactions.add(transaction)
+        if evicted is None:
+            return False
+        self.__ledger.add_pending(transaction)
+        self.__revision += 1
+        for tx in evicted:
+            print('Mempool full, dropping transaction from {}'.format(tx.sender))
+            self.__ledger.remove_pending(tx)
+        return True
+
+
+    def sync_from(self, node, peer_height):
+        """ Brings our chain up to date with a longer chain of a peer by only
+        downloading the blocks we are missing.
+
+        The fork point (the last block both chains share) is found by comparing
+        block hashes from the peer's headers with ours, walking back from our
+        last block. Only the blocks after the fork point are downloaded and
+        verified. Returns True if our chain was updated.
+
+        No lock is held while talking to the peer. If our block at the fork
+        point was replaced in the meantime, or our chain grew at least as long
+        as the downloaded one, nothing is changed.
+
+        Arguments:
+            :node: The url of the peer node.
+            :peer_height: The index of the last block of the peer.
+        """
+        with self.__lock.read():
+            local_height = len(self.__chain) - 1
+        if peer_height <= local_height:
+            return False
+        # Find the fork point
+        fork = None
+        end = local_height
+        while fork is None and end >= 0:
+            start = max(end - HEADER_BATCH + 1, 0)
+            headers = self.__fetch_json(node, 'chain/headers?start={}&limit={}'.format(start, end - start + 1))
+            if not headers:
+                return False
+            with self.__lock.read():
+                for header in reversed(headers):
+                    if header['index'] < len(self.__chain) and header['hash'] == self.__hash_at(header['index']):
+                        fork = header['index']
+                        fork_hash = header['hash']
+                        break
+            end = start - 1
+        if fork is None:
+            return False
+        # Download the missing blocks
+        new_blocks = []
+        while fork + len(new_blocks) < peer_height:
+            response, _ = self.__broadcaster.fetch([node], 'chain/blocks?start={}&limit={}'.format(
+                fork + len(new_blocks) + 1, BLOCK_BATCH), CHAIN_TIMEOUT, BINARY_HEADERS)[node]
+            blocks = self.__parse_blocks(response)
+            if not blocks:
+                return False
+            new_blocks.extend(blocks)
+        with self.__lock.read():
+            if fork >= len(self.__chain) or self.__hash_at(fork) != fork_hash:
+                return False
+            fork_block = self.__chain[fork]
+            timestamps = self.__get_timestamps(fork)
+        # Only the new blocks (and their link to our block at the fork point) need to be verified
+        verifier = ChainVerifier(fork_block, fork, self.verify_processes, timestamps, self.block_time)
+        for block in new_blocks:
+            verifier.add(block)
+        invalid = verifier.get_first_invalid()
+        if invalid is None:
+            # The transactions are checked the same way as those of a block received by add_block()
+            invalid = self.__check_new_blocks(new_blocks)
+            if invalid is not None:
+                invalid += fork + 1
+        if invalid is not None:
+            print('Block {} from {} is invalid'.format(invalid, node))
+            return False
+        if not self.__switch_to_fork(fork, fork_hash, new_blocks):
+            return False
+        print('Synced {} blocks from {} (fork at {})'.format(len(new_blocks), node, fork))
         return True
 
 
+    def __switch_to_fork(self, fork, fork_hash, new_blocks):
+        """ Replaces the blocks after the fork point with verified blocks of a
+        longer chain. Returns False without changing anything if our chain
+        changed in the meantime: our block at the fork point was replaced or
+        our chain is now at least as long as the new one.
+
+        Arguments:
+            :fork: Index of the last block the new chain shares with ours.
+            :fork_hash: The hash of that block.
+            :new_blocks: The verified blocks following the fork point (see
+            also __check_new_blocks()).
+        """
+        with self.__lock.write(), self.__state_lock:
+            if fork >= len(self.__chain) or self.__hash_at(fork) != fork_hash:
+                return False
+            if fork + 1 + len(new_blocks) <= len(self.__chain):
+                return False
+            # Reject transactions which are already confirmed before the fork point
+            for block in new_blocks:
+                for tx in block.transactions[:-1]:
+                    location = self.__txindex.get_location(hash_transaction(tx))
+                    if location is not None and location[0] <= fork:
+                        print('Block {} contains a confirmed transaction'.format(block.index))
+                        return False
+            local_height = len(self.__chain) - 1
+            if fork < local_height:
+                for index in range(fork + 1, local_height + 1):
+                    del self.__heights[self.__hash_at(index)]
+                self.__chain.truncate(fork + 1)
+                try:
+                    self.__txindex.truncate(fork + 1)
+                    self.__storage.truncate(fork + 1)
+                except IOError:
+                    print('Saving failed!')
+                if self.__verified[0] > fork:
+                    self.__verified = (fork, fork_hash)
+                # Our open transactions might depend on the blocks we dropped
+                self.__open_transactions.clear()
+                self.__ledger.rebuild(self.__chain, self.__open_transactions)
+                self.__addresses.rebuild(self.__chain)
+            for block in new_blocks:
+                self.__append_block(block)
+                self.__remove_open(block.transactions)
+            self.save_data()
+            return True
+
+
+    def __check_new_blocks(self, blocks):
+        """ Checks the transactions of blocks following each other like
+        add_block() does, returns the position of the first invalid block or
+        None. Whether a transaction is already confirmed in the blocks before
+        them is left to __switch_to_fork(). No lock is needed.
+
+        Arguments:
+            :blocks: The blocks of a peer, starting after the fork point.
+        """
+        seen = set()
+        for (position, block) in enumerate(blocks):
+            txids = self.__check_transactions(block)
+            if txids is None:
+                return position
+            # A transaction can only be confirmed once in the whole chain
+            if not seen.isdisjoint(txids):
+                return position
+            seen.update(txids)
+        return None
+
+
+    def __find_checkpoint(self, blocks):
+        """ Returns (height, hash) of the last block of a peer chain which is
+        also part of the verified part of our chain, or None if the chains
+        don't even share the genesis block.
+
+        The shared blocks form a prefix, so the last one is found with a binary
+        search hashing only a few peer blocks. The peer's blocks up to it are
+        never used, we keep our own (see resolve()).
+
+        Arguments:
+            :blocks: The blocks of the peer chain.
+        """
+        def matches(index):
+            try:
+                return hash_block(blocks[index]) == self.__hash_at(index)
+            except ValueError:
+                # A malformed block can't be one of ours
+                return False
+
+        with self.__lock.read():
+            low = 0
+            high = min(self.__verified[0], len(blocks) - 1, len(self.__chain) - 1)
+            if high < 0 or not matches(0):
+                return None
+            while low < high:
+                middle = (low + high + 1) // 2
+                if matches(middle):
+                    low = middle
+                else:
+                    high = middle - 1
+            return low, self.__hash_at(low)
+
+
+    def __fetch_json(self, node, path):
+        """ Sends a GET request to a single peer and returns the decoded json or None. """
+        response, _ = self.__broadcaster.fetch([node], path, CHAIN_TIMEOUT)[node]
+        if response is None or response.status_code != 200:
+            return None
+        return response.json()
+
+
+    @staticmethod
+    def __parse_blocks(response):
+        """ Returns the blocks of a peer response or None. Peers answer in the
+        binary format if they support it and in json otherwise.
+        """
+        if response is None or response.status_code != 200:
+            return None
+        # The hashes sent along by the peer are ignored and calculated by us
+        if response.headers.get('Content-Type', '').startswith(MIMETYPE):
+            return decode_blocks(response.content)
+        return [Block.from_dict(block) for block in response.json()]
+
+
     def resolve(self):
         """Resolve conflicts. Essentially just checking for longer/shorter chains. 
         Will replace the local one with a longer valid chain.
+
+        All peers are asked for the height of their chain first. For the peers
+        with the longest chains we first try to only fetch the blocks we are
+        missing (see sync_from()), if that fails their whole chains are
+        downloaded (concurrently) and verified (in parallel). Peers with shorter
+        chains are only tried if none of the longest chains is valid.
+
+        Downloading and verifying happens without holding a lock, the write lock
+        is only taken to swap in the new chain. Blocks a peer chain shares with
+        the verified part of ours are not verified again, we only switch to the
+        blocks after them.
         """
-        winner_chain = self.chain
+        winner_chain = None
+        winner_checkpoint = None
+        with self.__lock.read():
+            local_chain_length = len(self.__chain)
         replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
-            try:
-                # Get response from the 'get' chain
-                response = requests.get(url)
-                # The response includes the blockchain of that node, store in node_Chain
-                node_chain = response.json()
-                # Extract from dictionary (since it is obtained from json) and create a list of 
-                # block objects. Using a nested list comp to also update the list of transactions
-                # to transaction objects.
-                node_chain = [Block(block['index'], block['previous_hash'], 
-                    [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], 
-                        block['proof'], block['timestamp']) for block in node_chain]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
+        synced = False
+        # Timing breakdown per peer, logged at the end
+        timings = {}
+        peer_heights = {}
+        for (node, (response, elapsed)) in self.__broadcaster.fetch(self.get_peer_nodes(), 'chain/height').items():
+            timings[node] = {'height': elapsed}
+            # If you can not reach a specific node just continue
+            if response is None or response.status_code != 200:
+                continue
+            peer_heights[node] = response.json()['height']
+        # Only chains which are longer than ours are candidates, longest first
+        candidate_heights = sorted(
+            {height for height in peer_heights.values() if height + 1 > local_chain_length}, reverse=True)
+        for height in candidate_heights:
+            candidates = [node for node in peer_heights if peer_heights[node] == height]
+            # Usually we only miss a few blocks, try fetching just those first
+            for node in candidates:
+                start = time()
+                synced = self.sync_from(node, height)
+                timings[node]['sync'] = time() - start
+                if synced:
+                    break
+            if synced:
+                break
+            node_chains = {}
+            for (node, (response, elapsed)) in self.__broadcaster.fetch(
+                    candidates, 'chain', CHAIN_TIMEOUT, BINARY_HEADERS).items():
+                timings[node]['download'] = elapsed
+                start = time()
+                # The response includes the blockchain of that node, create a list of block objects
+                node_chain = self.__parse_blocks(response)
+                timings[node]['parse'] = time() - start
+                if node_chain is None:
+                    continue
                 # If the peer node blockchain is longer than ours then we want to use its blockchain 
                 # rather than our out of date local one
-                if node_chain_length > local_chain_length and Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
+                if len(node_chain) > local_chain_length:
+                    node_chains[node] = node_chain
+            nodes = list(node_chains)
+            checkpoints = [self.__find_checkpoint(node_chains[node]) for node in nodes]
+            # The peer's blocks before a checkpoint aren't verified, the difficulty after it follows from ours
+            with self.__lock.read():
+                timestamps = [None if checkpoint is None else self.__get_timestamps(checkpoint[0])
+                              for checkpoint in checkpoints]
+            results = Verification.verify_chains(
+                [node_chains[node] for node in nodes], self.verify_processes, checkpoints, self.block_time, timestamps)
+            for (node, checkpoint, (invalid, elapsed)) in zip(nodes, checkpoints, results):
+                timings[node]['verify'] = elapsed
+                if invalid is None and winner_chain is None:
+                    # Only the transactions of the blocks we would switch to are checked
+                    fork = 0 if checkpoint is None else checkpoint[0]
+                    start = time()
+                    invalid = self.__check_new_blocks(node_chains[node][fork + 1:])
+                    timings[node]['transactions'] = time() - start
+                    if invalid is not None:
+                        invalid += fork + 1
+                if invalid is not None:
+                    print('Chain of {} is invalid from block {}'.format(node, invalid))
+                elif winner_chain is None:
+                    winner_chain = node_chains[node]
+                    winner_checkpoint = checkpoint
                     replace = True
-            # If you can not reach a specific node just continue
-            except requests.exceptions.ConnectionError:
-                continue
+            if replace:
+                break
+        for (node, timing) in timings.items():
+            print('Resolve {}: {}'.format(node, ', '.join(
+                '{} {:.3f}s'.format(step, seconds) for (step, seconds) in timing.items())))
         self.resolve_conflicts = False
-        # Replace our chain with the longest valid chain from the peer nodes surveyed
-        self.chain = winner_chain
-        # If we need to update our chain, then we can assume our open transactions might be 
-        # wrong and therefore we must clear them. 
-        if replace:
-            self.__open_transactions = []
+        if replace and winner_checkpoint is not None:
+            # Our blocks up to the checkpoint stay, only the ones after it are replaced
+            fork, fork_hash = winner_checkpoint
+            replace = self.__switch_to_fork(fork, fork_hash, winner_chain[fork + 1:])
+        elif replace:
+            with self.__lock.write(), self.__state_lock:
+                # Our chain might have grown while the peer chains were downloaded
+                replace = len(winner_chain) > len(self.__chain)
+                if replace:
+                    # If we need to update our chain, then we can assume our open transactions might be 
+                    # wrong and therefore we must clear them. 
+                    self.__open_transactions.clear()
+                    # Write the new chain first, blocks which aren't resident are paged in from it
+                    try:
+                        # The index is emptied first so it is never ahead of the stored chain
+                        self.__txindex.truncate(0)
+                        self.__storage.replace_blocks(self.__seal(block) for block in winner_chain)
+                        self.__txindex.replace(winner_chain)
+                    except IOError:
+                        print('Saving failed!')
+                    # Replace our chain with the longest valid chain from the peer nodes surveyed
+                    self.chain = winner_chain
+                    # The whole chain was verified
+                    self.__verified = (len(winner_chain) - 1, winner_chain[-1].hash)
+                    self.__ledger.rebuild(winner_chain, self.__open_transactions)
+                    self.__addresses.rebuild(winner_chain)
         self.save_data()
-        return replace
+        return replace or synced
 
 
     def add_peer_node(self, node):
@@ -398,8 +1110,9 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be added
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__state_lock:
+            self.__peer_nodes.add(node)
+            self.save_data()
 
 
     def remove_peer_nodes(self, node):
@@ -408,10 +1121,12 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be added
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.__state_lock:
+            self.__peer_nodes.discard(node)
+            self.save_data()
 
     
     def get_peer_nodes(self):
         """Returns a list of all connected peer nodes."""
-        return list(self.__peer_nodes)
\ No newline at end of file
+        with self.__state_lock:
+            return list(self.__peer_nodes)
\ No newline at end of file
@@ -0,0 +1,74 @@
+""" Selects the open transactions that go into the next block. """
+
+import struct
+
+from utility.codec import encode_transaction
+from utility.verification import Verification
+
+# Default maximum number of open transactions in a block (the reward comes on top)
+MAX_BLOCK_TRANSACTIONS = 1000
+# Default maximum size of the open transactions in a block, in bytes of the binary format
+MAX_BLOCK_BYTES = 1000000
+
+
+def _encoded_size(transaction):
+    """ Returns the size of a transaction in the binary format, None if it can't be encoded. """
+    try:
+        return len(encode_transaction(transaction))
+    except (struct.error, TypeError, ValueError, AttributeError):
+        return None
+
+
+def build_template(transactions,
+                   get_confirmed_balance,
+                   is_confirmed,
+                   max_transactions=MAX_BLOCK_TRANSACTIONS,
+                   max_bytes=MAX_BLOCK_BYTES,
+                   processes=1):
+    """ Picks the transactions of the next block and returns them together with
+    the transactions which can never become valid.
+
+    Transactions paying the highest fee per byte are picked first, among equal
+    fees the older ones. A transaction is skipped instead of failing the whole
+    block if its signature, amount or fee is invalid, it was already confirmed
+    or it can't be encoded (all are returned as rejected), if its sender can't
+    pay for it on top of the transactions already picked, or if it doesn't fit
+    anymore (both stay open).
+
+    Arguments:
+        :transactions: The open transactions, oldest first.
+        :get_confirmed_balance: Returns the balance of an address without open transactions.
+        :is_confirmed: Returns True for a transaction which is already part of the chain.
+        :max_transactions: Maximum number of transactions to pick.
+        :max_bytes: Maximum total size of the picked transactions.
+        :processes: Number of processes used to verify the signatures.
+    """
+    sizes = {id(tx): _encoded_size(tx) for tx in transactions}
+    # A transaction which can't be stored would fail the whole block, peers reject
+    # blocks with invalid amounts or fees
+    rejected = [tx for tx in transactions if sizes[id(tx)] is None
+                or not Verification.valid_amount(tx.amount) or not Verification.valid_fee(tx.fee)]
+    invalid = {id(tx) for tx in rejected}
+    # sorted() is stable, so transactions with the same fee rate keep their order
+    candidates = sorted((tx for tx in transactions if id(tx) not in invalid),
+                        key=lambda tx: tx.fee / sizes[id(tx)], reverse=True)
+    valid = Verification.verify_transactions(candidates, processes)
+    selected = []
+    spent = {}
+    used_bytes = 0
+    for (tx, signature_valid) in zip(candidates, valid):
+        if not signature_valid or is_confirmed(tx):
+            rejected.append(tx)
+            continue
+        if len(selected) >= max_transactions:
+            break
+        if used_bytes + sizes[id(tx)] > max_bytes:
+            continue
+        # Coins received in this block can't be spent in it as well
+        total = spent.get(tx.sender, 0) + tx.get_total()
+        if total > get_confirmed_balance(tx.sender):
+            continue
+        spent[tx.sender] = total
+        used_bytes += sizes[id(tx)]
+        selected.append(tx)
+    return selected, rejected
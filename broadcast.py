@@ -0,0 +1,135 @@
+""" Sends transactions and blocks to the peer nodes in the background. """
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from time import perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of peers that are contacted at the same time
+BROADCAST_WORKERS = 8
+# Seconds to wait for a peer to connect / respond before giving up on it
+PEER_TIMEOUT = (2, 5)
+
+
+class Broadcaster:
+    """ Delivers messages to peer nodes without blocking the caller.
+
+    Every peer has its own outbound queue, which a worker thread works
+    through in the order the messages were queued while there is something in
+    it. The peers are served concurrently over a pooled HTTP session, so
+    connections to peers are kept alive and a slow peer only delays the
+    messages to itself (as long as fewer than all workers are stuck on slow
+    peers).
+
+    Attributes:
+        :session (private): The HTTP session holding the connection pool.
+        :executor (private): Threads sending the messages to the single peers.
+        :outbound (private): Peer node -> queue of messages that still have to be
+        sent to it, a peer only has one while a worker is delivering to it.
+        :unsent (private): Number of messages (per peer) that weren't sent yet.
+        :lock (private): Guards the outbound queues and the unsent count.
+        :sent (private): Notified once every queued message was sent.
+    """
+
+    def __init__(self, workers=BROADCAST_WORKERS, timeout=PEER_TIMEOUT):
+        self.timeout = timeout
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.__session.mount('http://', adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__outbound = {}
+        self.__unsent = 0
+        self.__lock = threading.Lock()
+        self.__sent = threading.Condition(self.__lock)
+
+    def broadcast(self, peers, path, payload, on_response=None):
+        """ Queues a message for all peers and returns right away.
+
+        Arguments:
+            :peers: The peer node urls the message should be sent to.
+            :path: The endpoint of the peers, e.g. 'broadcast-block'.
+            :payload: The json payload of the message.
+            :on_response: Called with (node, response) for every peer that answered.
+        """
+        with self.__lock:
+            for node in peers:
+                if node not in self.__outbound:
+                    # Nobody is delivering to this peer yet
+                    self.__outbound[node] = deque()
+                    self.__executor.submit(self.__deliver, node)
+                self.__outbound[node].append((path, payload, on_response))
+                self.__unsent += 1
+
+    def fetch(self, peers, path, timeout=None, headers=None):
+        """ Sends a GET request to all peers at the same time and waits for the
+        answers. Returns a dictionary of node -> (response or None, seconds taken).
+
+        Arguments:
+            :peers: The peer node urls to ask.
+            :path: The endpoint of the peers, e.g. 'chain'.
+            :timeout: Overrides the default (connect, read) timeout.
+            :headers: Additional request headers, e.g. the accepted content types.
+        """
+        peers = list(peers)
+        futures = [self.__executor.submit(self.__get, node, path, timeout, headers) for node in peers]
+        return {node: future.result() for (node, future) in zip(peers, futures)}
+
+    def flush(self):
+        """ Blocks until every queued message was sent. """
+        with self.__sent:
+            self.__sent.wait_for(lambda: self.__unsent == 0)
+
+    def __deliver(self, node):
+        """ Sends the queued messages to a single peer until its queue is empty. """
+        while True:
+            with self.__lock:
+                pending = self.__outbound[node]
+                if not pending:
+                    del self.__outbound[node]
+                    return
+                # The message stays queued while it is sent, so broadcast() doesn't start a second worker
+                path, payload, on_response = pending[0]
+            try:
+                response = self.__post(node, path, payload)
+                if response is not None and on_response is not None:
+                    on_response(node, response)
+            except Exception as e:
+                print('Broadcast failed: {}'.format(e))
+            finally:
+                with self.__lock:
+                    pending.popleft()
+                    self.__unsent -= 1
+                    if self.__unsent == 0:
+                        self.__sent.notify_all()
+
+    def __get(self, node, path, timeout, headers):
+        url = 'http://{}/{}'.format(node, path)
+        start = perf_counter()
+        try:
+            response = self.__session.get(url, headers=headers, timeout=timeout or self.timeout)
+        except requests.exceptions.RequestException:
+            response = None
+        return response, perf_counter() - start
+
+    def __post(self, node, path, payload):
+        url = 'http://{}/{}'.format(node, path)
+        try:
+            return self.__session.post(url, json=payload, timeout=self.timeout)
+        # If we can't reach a specific node, skip it
+        except requests.exceptions.RequestException:
+            return None
+
+
+# Shared by all Blockchain objects of this process (node.py creates a new one per wallet)
+_broadcaster = None
+
+
+def get_broadcaster():
+    """ Returns the broadcaster of this process. """
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster()
+    return _broadcaster
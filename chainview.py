@@ -0,0 +1,37 @@
+from collections.abc import Sequence
+
+
+class ChainView(Sequence):
+    """ A read-only sequence of the first blocks of a blockchain, returned by
+    Blockchain.chain instead of a copy of the whole chain.
+
+    Taking the view only remembers the length of the chain at that time,
+    blocks are read (and paged in from disk if necessary) when they are
+    accessed. Blocks appended later are not part of the view. If the chain is
+    replaced by a fork in the meantime, indexing returns the blocks of the new
+    chain while iterating stops early (see Blockchain.iter_blocks()).
+
+    Attributes:
+        :blockchain (private): The blockchain the blocks are read from.
+        :length (private): Number of blocks in the view.
+    """
+
+    def __init__(self, blockchain, length):
+        self.__blockchain = blockchain
+        self.__length = length
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.__length))]
+        if index < 0:
+            index += self.__length
+        if index < 0 or index >= self.__length:
+            raise IndexError('block index out of range')
+        return self.__blockchain.get_block(index)
+
+    def __iter__(self):
+        # Reads the blocks in batches instead of one lookup per block
+        return self.__blockchain.iter_blocks(0, self.__length)
@@ -0,0 +1,113 @@
+""" Difficulty of the proof of work and its adjustment to the block time.
+
+The difficulty of a block is the number of leading zero bits the hash of its
+proof needs. Every RETARGET_INTERVAL blocks it is adjusted by one bit (which
+halves or doubles the work) if the last blocks came much faster or slower than
+the block time, otherwise a block has the difficulty of the block before it.
+The block time is part of the rules every node checks, all nodes of a network
+have to use the same one.
+
+The timestamps the difficulty is measured with are kept honest: a block has to
+be newer than the median of the RETARGET_INTERVAL blocks before it and must not
+be more than MAX_FUTURE_TIME seconds ahead of the clock of the node checking it.
+
+Blocks of older versions don't have a difficulty (None). Their proofs have one
+leading zero byte, the same as INITIAL_DIFFICULTY, and they are only valid as
+long as no block before them has a difficulty.
+"""
+
+import math
+from statistics import median
+
+# Difficulty of the first blocks and of the blocks of older versions
+INITIAL_DIFFICULTY = 8
+# Bounds of the difficulty, stored in a single byte of the binary format
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 255
+# Targeted number of seconds between two blocks
+BLOCK_TIME = 10
+# Number of blocks after which the difficulty is adjusted (and which are looked at)
+RETARGET_INTERVAL = 10
+# Number of seconds the timestamp of a block may be ahead of our clock
+MAX_FUTURE_TIME = 120
+
+# A proof hash is valid if it is smaller than the target of its difficulty. Comparing
+# the raw 32 byte digests gives the same result as comparing them as numbers.
+_TARGETS = tuple((1 << (256 - difficulty)).to_bytes(32, 'big') if difficulty > 0 else None
+                 for difficulty in range(MAX_DIFFICULTY + 1))
+
+
+def get_target(difficulty):
+    """ Returns the target a proof hash (raw digest) has to be smaller than.
+
+    Arguments:
+        :difficulty: Number of leading zero bits, None for blocks of older versions.
+    """
+    if difficulty is None:
+        difficulty = INITIAL_DIFFICULTY
+    if not isinstance(difficulty, int) or not MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY:
+        # Nothing is smaller, a block with an invalid difficulty never has a valid proof
+        return b''
+    return _TARGETS[difficulty]
+
+
+def next_difficulty(height, previous_difficulty, timestamps, block_time=BLOCK_TIME):
+    """ Returns the difficulty the block at a height must have.
+
+    Arguments:
+        :height: The index of the block.
+        :previous_difficulty: The difficulty of the block before it.
+        :timestamps: The timestamps of the blocks before it, oldest first. Only
+        the last RETARGET_INTERVAL are used.
+        :block_time: Targeted number of seconds between two blocks.
+    """
+    difficulty = INITIAL_DIFFICULTY if previous_difficulty is None else previous_difficulty
+    # The genesis block has no real timestamp, it is never part of the measured blocks
+    if height % RETARGET_INTERVAL != 0 or height <= RETARGET_INTERVAL:
+        return difficulty
+    elapsed = timestamps[-1] - timestamps[-RETARGET_INTERVAL]
+    expected = (RETARGET_INTERVAL - 1) * block_time
+    if elapsed < expected / 2:
+        return min(difficulty + 1, MAX_DIFFICULTY)
+    if elapsed > expected * 2:
+        return max(difficulty - 1, MIN_DIFFICULTY)
+    return difficulty
+
+
+def valid_difficulty(difficulty, height, previous_difficulty, timestamps, block_time=BLOCK_TIME):
+    """ Checks the difficulty of a block against the one expected at its height.
+
+    Arguments:
+        :difficulty: The difficulty of the block.
+        :height: The index of the block.
+        :previous_difficulty: The difficulty of the block before it.
+        :timestamps: The timestamps of the blocks before it (see next_difficulty()).
+        :block_time: Targeted number of seconds between two blocks.
+    """
+    if difficulty is None:
+        # Blocks of older versions can't follow a block with a difficulty
+        return previous_difficulty is None
+    return difficulty == next_difficulty(height, previous_difficulty, timestamps, block_time)
+
+
+def get_min_timestamp(timestamps):
+    """ Returns the smallest timestamp the next block can have, the first number
+    greater than the median of the last RETARGET_INTERVAL timestamps.
+
+    Arguments:
+        :timestamps: The timestamps of the blocks before it, oldest first (at least one).
+    """
+    return math.nextafter(median(list(timestamps)[-RETARGET_INTERVAL:]), math.inf)
+
+
+def valid_timestamp(timestamp, timestamps, now):
+    """ Checks the timestamp of a block against the blocks before it and our clock.
+
+    Arguments:
+        :timestamp: The timestamp of the block.
+        :timestamps: The timestamps of the blocks before it (see get_min_timestamp()).
+        :now: Our current time.
+    """
+    if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool) or not math.isfinite(timestamp):
+        return False
+    return get_min_timestamp(timestamps) <= timestamp <= now + MAX_FUTURE_TIME
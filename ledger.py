@@ -0,0 +1,65 @@
+class Ledger:
+    """ Keeps a running balance for every address so that balance lookups
+    don't have to rescan the whole blockchain.
+
+    Attributes:
+        :confirmed (private): Net amount (received - sent) per address for
+        all transactions that are part of the chain.
+        :pending (private): Amount per address that is tied up in open
+        transactions (outgoing only, incoming coins can't be spent yet).
+        Fees count as outgoing, the miner receives them with the reward.
+    """
+
+    def __init__(self):
+        self.__confirmed = {}
+        self.__pending = {}
+
+    def apply_block(self, block):
+        """ Adds the transactions of a newly appended block to the balances.
+
+        Arguments:
+            :block: The block that was appended to the chain.
+        """
+        for tx in block.transactions:
+            self.__confirmed[tx.sender] = self.__confirmed.get(tx.sender, 0) - tx.get_total()
+            self.__confirmed[tx.recipient] = self.__confirmed.get(tx.recipient, 0) + tx.amount
+
+    def add_pending(self, transaction):
+        """ Reserves the amount of a new open transaction for its sender. """
+        self.__pending[transaction.sender] = self.__pending.get(transaction.sender, 0) + transaction.get_total()
+
+    def remove_pending(self, transaction):
+        """ Releases the reserved amount of an open transaction which left the
+        open transactions (e.g. because it got included in a block).
+        """
+        remaining = self.__pending.get(transaction.sender, 0) - transaction.get_total()
+        if remaining:
+            self.__pending[transaction.sender] = remaining
+        else:
+            self.__pending.pop(transaction.sender, None)
+
+    def rebuild(self, chain, open_transactions):
+        """ Recalculates all balances from scratch.
+
+        Arguments:
+            :chain: The blocks to calculate the confirmed balances from.
+            :open_transactions: The transactions which are still pending.
+        """
+        self.__confirmed = {}
+        self.__pending = {}
+        for block in chain:
+            self.apply_block(block)
+        for tx in open_transactions:
+            self.add_pending(tx)
+
+    def get_confirmed_balance(self, participant):
+        """ Returns the balance of a participant without the open transactions. """
+        return self.__confirmed.get(participant, 0)
+
+    def get_balance(self, participant):
+        """ Returns the spendable balance of a participant.
+
+        Arguments:
+            :participant: The address for which to look up the balance.
+        """
+        return self.__confirmed.get(participant, 0) - self.__pending.get(participant, 0)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+from utility.hash_util import hash_transaction
+
+# Default maximum number of open transactions a node keeps
+MEMPOOL_SIZE = 10000
+
+
+class Mempool:
+    """ Holds the open transactions of a node, indexed by transaction id.
+
+    Adding, looking up and removing a transaction doesn't depend on the number
+    of open transactions. Iterating returns the transactions in the order they
+    were added, which is the order they go into the next block.
+
+    get_transactions() returns a tuple which is reused until the transactions
+    change, so reading the open transactions over and over doesn't copy them.
+
+    Attributes:
+        :max_size: Maximum number of transactions, the oldest ones are evicted
+        when it is exceeded.
+        :transactions (private): Transaction id -> transaction, oldest first.
+        :snapshot (private): The tuple returned by get_transactions() or None
+        if it has to be built again.
+    """
+
+    def __init__(self, max_size=MEMPOOL_SIZE):
+        self.max_size = max_size
+        self.__transactions = OrderedDict()
+        self.__snapshot = None
+
+    def __len__(self):
+        return len(self.__transactions)
+
+    def __iter__(self):
+        return iter(self.__transactions.values())
+
+    def __contains__(self, transaction):
+        return hash_transaction(transaction) in self.__transactions
+
+    def add(self, transaction):
+        """ Adds a transaction unless it is already known. Returns the list of
+        transactions evicted to make room, or None if the transaction wasn't added.
+
+        Arguments:
+            :transaction: The new open transaction.
+        """
+        txid = hash_transaction(transaction)
+        if txid in self.__transactions:
+            return None
+        self.__transactions[txid] = transaction
+        self.__snapshot = None
+        evicted = []
+        while len(self.__transactions) > self.max_size:
+            evicted.append(self.__transactions.popitem(last=False)[1])
+        return evicted
+
+    def get(self, txid):
+        """ Returns the open transaction with the given id or None. """
+        return self.__transactions.get(txid)
+
+    def remove(self, transactions):
+        """ Removes the given transactions (e.g. the ones which made it into a
+        block) and returns those that were actually open.
+
+        Arguments:
+            :transactions: The transactions to remove, unknown ones are skipped.
+        """
+        removed = []
+        for transaction in transactions:
+            removed_transaction = self.__transactions.pop(hash_transaction(transaction), None)
+            if removed_transaction is not None:
+                removed.append(removed_transaction)
+        if removed:
+            self.__snapshot = None
+        return removed
+
+    def clear(self):
+        """ Drops all open transactions. """
+        self.__transactions = OrderedDict()
+        self.__snapshot = None
+
+    def get_transactions(self):
+        """ Returns the open transactions as tuple, oldest first. """
+        if self.__snapshot is None:
+            self.__snapshot = tuple(self.__transactions.values())
+        return self.__snapshot
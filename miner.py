@@ -0,0 +1,177 @@
+""" Proof of work search spread over several processes and the background
+mining service of a node.
+"""
+
+import hashlib as hl
+import multiprocessing
+import queue
+import threading
+from time import time
+
+from difficulty import get_target
+from utility.hash_util import pack_header_prefix
+from utility.verification import Verification
+
+# Number of proofs a worker tries before it checks whether another worker was successful
+CHECK_INTERVAL = 1000
+# Seconds between checks whether a running search should be given up
+STOP_CHECK_INTERVAL = 0.1
+# Seconds the mining service waits before it looks for open transactions again
+IDLE_INTERVAL = 0.5
+
+
+def _search(prefix, target, start, step, found, results, progress):
+    """ Tries every step-th proof beginning at start until a valid one is found
+    by this or any other worker. Puts (proof or None, number of hashes tried)
+    on the results queue when done, while searching the number of hashes
+    tried so far is stored in progress[start].
+    """
+    # Same as Verification.prepare_header(), only the header bytes are sent to the worker
+    prepared = hl.sha256(prefix)
+    proof = start
+    tried = 0
+    while not found.is_set():
+        for _ in range(CHECK_INTERVAL):
+            tried += 1
+            if Verification.valid_prepared_header(prepared, proof, target):
+                found.set()
+                results.put((proof, tried))
+                return
+            proof += step
+        progress[start] = tried
+    results.put((None, tried))
+
+
+def parallel_proof_of_work(block, processes, should_stop=None, on_progress=None):
+    """ Searches a valid proof with several processes and returns it together
+    with the total number of hashes that were calculated.
+
+    The proof space is split by striding, worker i tries i, i + processes,
+    i + 2 * processes, ... so no proof is tried twice. All workers stop as soon
+    as one of them found a valid proof.
+
+    Arguments:
+        :block: The new block, everything but its proof is set.
+        :processes: Number of worker processes.
+        :should_stop: Called regularly, if it returns True the search is given
+        up and the proof is None.
+        :on_progress: Called regularly with the number of hashes calculated so far.
+    """
+    # The workers only need the fixed-size header, not the transactions
+    prefix = pack_header_prefix(block)
+    target = get_target(block.difficulty)
+    found = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    # One counter per worker, so they don't have to share a lock
+    progress = multiprocessing.Array('Q', processes, lock=False)
+    workers = [multiprocessing.Process(
+        target=_search,
+        args=(prefix, target, start, processes, found, results, progress),
+        daemon=True) for start in range(processes)]
+    for worker in workers:
+        worker.start()
+    proof = None
+    hashes = 0
+    # Every worker reports exactly once, either with its proof or after it was stopped
+    reported = 0
+    while reported < len(workers):
+        try:
+            worker_proof, tried = results.get(timeout=STOP_CHECK_INTERVAL)
+        except queue.Empty:
+            if on_progress is not None:
+                on_progress(sum(progress))
+            if should_stop is not None and should_stop():
+                found.set()
+            continue
+        reported += 1
+        hashes += tried
+        if proof is None and worker_proof is not None:
+            proof = worker_proof
+    for worker in workers:
+        worker.join()
+    return proof, hashes
+
+
+class MiningService:
+    """ Mines blocks in a background thread until it is stopped.
+
+    The search for a proof is restarted whenever the chain or the open
+    transactions change (a block was received or mined, a transaction was
+    added), so the node always mines on top of its newest block and includes
+    the newest transactions.
+
+    Attributes:
+        :blockchain: The blockchain new blocks are added to.
+        :empty_blocks: Whether blocks are mined without open transactions
+        (only for the reward).
+        :blocks_mined: Number of blocks mined since the service was created.
+        :last_block_time: Time the last block was mined at.
+        :stopping (private): Set when the service should stop.
+        :thread (private): The thread mining the blocks.
+    """
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.empty_blocks = False
+        self.blocks_mined = 0
+        self.last_block_time = None
+        self.__stopping = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def start(self, empty_blocks=False):
+        """ Starts mining, returns False if the service is already running.
+
+        Arguments:
+            :empty_blocks: Also mine blocks if there are no open transactions.
+        """
+        with self.__lock:
+            if self.is_running():
+                return False
+            self.empty_blocks = empty_blocks
+            self.__stopping.clear()
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+            return True
+
+    def stop(self):
+        """ Stops mining and waits until the current search was given up. """
+        with self.__lock:
+            self.__stopping.set()
+            if self.__thread is not None:
+                self.__thread.join()
+                self.__thread = None
+
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def get_status(self):
+        """ Returns the state of the service as dictionary. """
+        return {
+            'running': self.is_running(),
+            'empty_blocks': self.empty_blocks,
+            'hash_rate': self.blockchain.hash_rate,
+            'blocks_mined': self.blocks_mined,
+            'last_block_time': self.last_block_time
+        }
+
+    def __run(self):
+        blockchain = self.blockchain
+        while not self.__stopping.is_set():
+            try:
+                if blockchain.resolve_conflicts:
+                    # A peer declined our last block, we are probably behind
+                    blockchain.resolve()
+                    continue
+                if not self.empty_blocks and not blockchain.get_open_transactions():
+                    self.__stopping.wait(IDLE_INTERVAL)
+                    continue
+                revision = blockchain.get_revision()
+                block = blockchain.mine_block(
+                    lambda: self.__stopping.is_set() or blockchain.get_revision() != revision)
+                if block is not None:
+                    self.blocks_mined += 1
+                    self.last_block_time = time()
+            except Exception as e:
+                print('Mining failed: {}'.format(e))
+                self.__stopping.wait(IDLE_INTERVAL)
@@ -1,12 +1,45 @@
-from flask import Flask, jsonify, request, send_from_directory
+import atexit
+import json
+import secrets
+import signal
+import struct
+import sys
+
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 
 from wallet import Wallet
 from blockchain import Blockchain
+from block import Block
+from blocktemplate import MAX_BLOCK_BYTES, MAX_BLOCK_TRANSACTIONS
+from difficulty import BLOCK_TIME
+from mempool import MEMPOOL_SIZE
+from miner import MiningService
+from utility import codec
+from utility.hash_util import hash_transaction
+from utility.verification import Verification
 
 app = Flask(__name__)
 CORS(app)
 
+# Maximum number of headers / blocks returned by a single range request
+MAX_HEADERS = 500
+MAX_BLOCKS = 100
+# Maximum number of transactions returned by a single address history request
+MAX_HISTORY = 100
+# Errors raised when a binary request body is cut off or damaged
+DECODE_ERRORS = (struct.error, IndexError, ValueError)
+
+
+def wants_binary():
+    # Json stays the default, the binary format is only used if the client prefers it
+    return request.accept_mimetypes.best_match(['application/json', codec.MIMETYPE]) == codec.MIMETYPE
+
+
+def binary_response(blocks, status=200):
+    # Length-prefixed binary records, streamed one block at a time
+    return Response(codec.encode_blocks(blocks), status=status, mimetype=codec.MIMETYPE)
+
 
 @app.route('/', methods=['GET'])
 def get_node_ui():
@@ -22,10 +55,11 @@ def get_network_ui():
 def create_keys():
     wallet.create_keys()
     if wallet.save_keys():
-        # Create our blockchain using a newly created public key
-        # Use global blockchain, don't create a new local variable
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The running miner would keep mining for the old key
+        mining_service.stop()
+        # The chain doesn't depend on our key, it is switched in place so requests
+        # running in other threads never see a half loaded blockchain
+        blockchain.public_key = wallet.public_key
         response = {
             'public_key': wallet.public_key,
             'private_key': wallet.private_key,
@@ -42,10 +76,11 @@ def create_keys():
 @app.route('/wallet', methods=['GET'])
 def load_keys():
     if wallet.load_keys():
-        # Create our blockchain using a newly created public key
-        # Use global blockchain, don't create a new local variable
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The running miner would keep mining for the old key
+        mining_service.stop()
+        # The chain doesn't depend on our key, it is switched in place so requests
+        # running in other threads never see a half loaded blockchain
+        blockchain.public_key = wallet.public_key
         response = {
             'public_key': wallet.public_key,
             'private_key': wallet.private_key,
@@ -102,10 +137,24 @@ def add_transaction():
         return jsonify(response), 400
     recipient = values['recipient']
     amount = values['amount']
+    # Optional fee for the miner, transactions with higher fees are mined first
+    fee = values.get('fee', 0)
+    if not Verification.valid_amount(amount):
+        response = {
+            'message': 'The amount has to be a number greater than 0.'
+        }
+        return jsonify(response), 400
+    if not Verification.valid_fee(fee):
+        response = {
+            'message': 'The fee has to be a number of at least 0.'
+        }
+        return jsonify(response), 400
+    # Random nonce so sending the same amount to the same recipient again isn't a replay
+    nonce = secrets.token_hex(8)
     # Create signature using request data
-    signature = wallet.sign_transaction(wallet.public_key, recipient, amount)
+    signature = wallet.sign_transaction(wallet.public_key, recipient, amount, nonce, fee)
     # Add new transaction
-    success = blockchain.add_transaction(recipient, wallet.public_key, signature, amount)
+    success = blockchain.add_transaction(recipient, wallet.public_key, signature, amount, nonce = nonce, fee = fee)
     if success:
         response = {
             'message': 'Successfully added transaction.',
@@ -113,7 +162,9 @@ def add_transaction():
                 'sender': wallet.public_key,
                 'recipient': recipient,
                 'amount': amount,
-                'signature': signature
+                'signature': signature,
+                'nonce': nonce,
+                'fee': fee
             },
             'funds': blockchain.get_balance()
         }
@@ -133,11 +184,11 @@ def mine():
         return jsonify(response), 409
     block = blockchain.mine_block()
     if block != None:
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
+        dict_block = block.to_dict()
         response = {
             'message': 'Block added succesfully.',
             'block': dict_block,
+            'hash_rate': blockchain.hash_rate,
             'funds': blockchain.get_balance()
         }
         return jsonify(response), 201
@@ -149,6 +200,42 @@ def mine():
         return jsonify(response), 500
 
 
+@app.route('/mining/start', methods=['POST'])
+def start_mining():
+    # Mine in the background until /mining/stop is called, e.g. {"empty_blocks": true}
+    if wallet.public_key == None:
+        response = {'message': 'No wallet setup.'}
+        return jsonify(response), 400
+    values = request.get_json(silent=True) or {}
+    if not mining_service.start(bool(values.get('empty_blocks', False))):
+        response = {'message': 'Mining is already running.', 'status': mining_service.get_status()}
+        return jsonify(response), 409
+    response = {'message': 'Mining started.', 'status': mining_service.get_status()}
+    return jsonify(response), 200
+
+
+@app.route('/mining/stop', methods=['POST'])
+def stop_mining():
+    mining_service.stop()
+    response = {'message': 'Mining stopped.', 'status': mining_service.get_status()}
+    return jsonify(response), 200
+
+
+@app.route('/mining/status', methods=['GET'])
+def get_mining_status():
+    response = mining_service.get_status()
+    response['height'] = blockchain.get_height()
+    response['difficulty'] = blockchain.get_next_difficulty()
+    response['block_time'] = blockchain.block_time
+    return jsonify(response), 200
+
+
+@app.route('/verification-cache', methods=['GET'])
+def get_verification_cache():
+    # How well the signature verification cache works for the received transactions and blocks
+    return jsonify(Wallet.verification_cache_info()), 200
+
+
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
     replaced = blockchain.resolve()
@@ -161,8 +248,15 @@ def resolve_conflicts():
 
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    # Extract values
-    values = request.get_json()
+    # Extract values, peers may send the transaction in the binary format
+    if request.mimetype == codec.MIMETYPE:
+        try:
+            values = codec.decode_transaction(request.get_data())[0].to_dict()
+        except DECODE_ERRORS:
+            response = {'message': 'Invalid transaction data.'}
+            return jsonify(response), 400
+    else:
+        values = request.get_json()
     if not values:
         response = {'message': 'No data found.'}
         return jsonify(response), 400
@@ -170,7 +264,13 @@ def broadcast_transaction():
     if not all(key in values for key in required):
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
-    success = blockchain.add_transaction(values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving = True)
+    if not Verification.valid_amount(values['amount']):
+        response = {'message': 'The amount has to be a number greater than 0.'}
+        return jsonify(response), 400
+    if not Verification.valid_fee(values.get('fee', 0)):
+        response = {'message': 'The fee has to be a number of at least 0.'}
+        return jsonify(response), 400
+    success = blockchain.add_transaction(values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving = True, nonce = values.get('nonce'), fee = values.get('fee', 0))
     if success:
         response = {
             'message': 'Successfully added transaction.',
@@ -178,7 +278,9 @@ def broadcast_transaction():
                 'sender': values['sender'],
                 'recipient': values['recipient'],
                 'amount': values['amount'],
-                'signature': values['signature']
+                'signature': values['signature'],
+                'nonce': values.get('nonce'),
+                'fee': values.get('fee', 0)
             }
         }
         return jsonify(response), 201
@@ -191,18 +293,28 @@ def broadcast_transaction():
 
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    # Extract json data to dictionary
-    values = request.get_json()
-    if not values:
-        response = {'message': 'No data found.'}
-        return jsonify(response), 400
-    if 'block' not in values:
-        response = {'message': 'Some data is missing.'}
-        return jsonify(response), 400
-    block = values['block']
+    # The hash sent along by the peer is dropped in both formats, we calculate it ourselves
+    if request.mimetype == codec.MIMETYPE:
+        try:
+            block = codec.decode_block(request.get_data())[0]
+        except DECODE_ERRORS:
+            response = {'message': 'Invalid block data.'}
+            return jsonify(response), 400
+    else:
+        # Extract json data to dictionary
+        values = request.get_json()
+        if not values:
+            response = {'message': 'No data found.'}
+            return jsonify(response), 400
+        if 'block' not in values:
+            response = {'message': 'Some data is missing.'}
+            return jsonify(response), 400
+        block = Block.from_dict(values['block'])
+    # Only look at the last block, copying the whole chain would page in every block
+    last_block = blockchain.get_tip()
     # Check to see if the index we receive is equal to our local blockchains
     # last block index + 1
-    if block['index'] == blockchain.chain[-1].index + 1:
+    if block.index == last_block.index + 1:
         if blockchain.add_block(block):
             response = {'message': 'Block added'}
             return jsonify(response), 201
@@ -211,7 +323,7 @@ def broadcast_block():
             # Http 409 - conflict
             return jsonify(response), 409
     # Blockchain we are receiving is longer than ours and we need to catch up
-    elif block['index'] > blockchain.chain[-1].index:
+    elif block.index > last_block.index:
         response = {'message': 'Blockchain seems to differ from local blockchain'}
         blockchain.resolve_conflicts = True
         # Still send a success code because it is an issue with our node, the request was successful
@@ -229,17 +341,120 @@ def get_open_transaction():
     # Return the list of transaction objects
     transactions = blockchain.get_open_transactions()
     # Convert transaction objects to dictionary representation
-    dict_transactions = [tx.__dict__ for tx in transactions]
+    dict_transactions = [tx.to_dict() for tx in transactions]
     return jsonify(dict_transactions), 200
 
 
+@app.route('/transaction/<txid>', methods=['GET'])
+def get_transaction(txid):
+    # Confirmed transactions are looked up in the transaction index, open ones in the mempool
+    found = blockchain.get_transaction(txid)
+    if found is None:
+        response = {'message': 'Transaction not found.'}
+        return jsonify(response), 404
+    transaction, height = found
+    response = {
+        'txid': hash_transaction(transaction),
+        'transaction': transaction.to_dict(),
+        'confirmed': height is not None,
+        'block': height
+    }
+    return jsonify(response), 200
+
+
+@app.route('/transaction/<txid>/proof', methods=['GET'])
+def get_transaction_proof(txid):
+    # Lets a light client check a payment with the block header only: the Merkle proof
+    # leads from the transaction id to the Merkle root in the header
+    found = blockchain.get_merkle_proof(txid)
+    if found is None:
+        response = {'message': 'Transaction not found in a block with a Merkle root.'}
+        return jsonify(response), 404
+    header, proof = found
+    response = {
+        'txid': txid,
+        'header': header,
+        'proof': proof
+    }
+    return jsonify(response), 200
+
+
+@app.route('/address/<address>/transactions', methods=['GET'])
+def get_address_transactions(address):
+    # Confirmed transactions of an address, newest first, e.g. /address/<key>/transactions?start=50&limit=50
+    start = max(request.args.get('start', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', MAX_HISTORY, type=int), 0), MAX_HISTORY)
+    total, history = blockchain.get_address_history(address, start, limit)
+    response = {
+        'total': total,
+        'start': start,
+        'limit': limit,
+        'transactions': [{
+            'txid': hash_transaction(transaction),
+            'transaction': transaction.to_dict(),
+            'block': height,
+            'position': position
+        } for (transaction, height, position) in history]
+    }
+    return jsonify(response), 200
+
+
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
-    return jsonify(dict_chain), 200
+    # The chain only changes when a new last block is added, so its hash identifies the response
+    etag = blockchain.get_last_hash()
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': '"{}"'.format(etag)})
+    # Optional pagination, e.g. /chain?start=100&limit=50, without it the whole chain is returned
+    start = request.args.get('start', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    blocks = blockchain.iter_blocks(start, limit)
+    if wants_binary():
+        response = binary_response(blocks)
+        response.set_etag(etag)
+        response.vary.add('Accept')
+        return response
+
+    def generate():
+        # Serialize one block at a time instead of building the whole chain in memory
+        yield '['
+        for (position, block) in enumerate(blocks):
+            yield (',' if position > 0 else '') + json.dumps(block.to_dict())
+        yield ']'
+
+    response = Response(generate(), status=200, mimetype='application/json')
+    response.set_etag(etag)
+    # The same chain is served in two formats
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/chain/height', methods=['GET'])
+def get_chain_height():
+    # Peers ask for the height first so they only download chains longer than theirs
+    response = {
+        'height': blockchain.get_height()
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/headers', methods=['GET'])
+def get_chain_headers():
+    # Headers by range, e.g. /chain/headers?start=100&limit=50
+    start = max(request.args.get('start', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', MAX_HEADERS, type=int), 0), MAX_HEADERS)
+    return jsonify(blockchain.get_headers(start, limit)), 200
+
+
+@app.route('/chain/blocks', methods=['GET'])
+def get_chain_blocks():
+    # Blocks by range, e.g. /chain/blocks?start=100&limit=50
+    start = max(request.args.get('start', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', MAX_BLOCKS, type=int), 0), MAX_BLOCKS)
+    if wants_binary():
+        return binary_response(blockchain.get_blocks(start, limit))
+    dict_blocks = [block.to_dict() for block in blockchain.get_blocks(start, limit)]
+    return jsonify(dict_blocks), 200
 
 
 @app.route('/node', methods=['POST'])
@@ -295,11 +510,38 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    # Number of processes searching for the proof of work, 1 mines in the node process itself
+    parser.add_argument('-m', '--mining-processes', type=int, default=1)
+    # Number of processes verifying transaction signatures of large batches
+    parser.add_argument('--verify-processes', type=int, default=1)
+    # Maximum number of open transactions, the oldest ones are dropped when it is exceeded
+    parser.add_argument('--mempool-size', type=int, default=MEMPOOL_SIZE)
+    # Limits of the blocks this node mines (number of transactions / bytes in the binary format)
+    parser.add_argument('--max-block-transactions', type=int, default=MAX_BLOCK_TRANSACTIONS)
+    parser.add_argument('--max-block-bytes', type=int, default=MAX_BLOCK_BYTES)
+    # Targeted seconds between blocks, the difficulty follows it (the same on all nodes of a network)
+    parser.add_argument('--block-time', type=float, default=BLOCK_TIME)
     # Give list of parsed in arguments
     args = parser.parse_args()
     port = args.port
+    mining_processes = max(args.mining_processes, 1)
+    verify_processes = max(args.verify_processes, 1)
+    mempool_size = max(args.mempool_size, 1)
+    max_block_transactions = max(args.max_block_transactions, 0)
+    max_block_bytes = max(args.max_block_bytes, 0)
+    block_time = max(args.block_time, 0)
+    # The verification workers are forked now, before any other threads are started
+    Verification.start_pool(verify_processes)
     # Initialize the wallet as none
     wallet = Wallet(port)
     # Create the blockchain with the initialized 'none' wallet
-    blockchain = Blockchain(wallet.public_key, port)
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    blockchain = Blockchain(wallet.public_key, port, mining_processes, verify_processes, mempool_size,
+                            max_block_transactions, max_block_bytes, block_time)
+    # Mines in the background once started through /mining/start
+    mining_service = MiningService(blockchain)
+    # Blocks are only synced to disk in batches, don't leave the last ones in the OS cache
+    atexit.register(blockchain.close)
+    # atexit handlers only run on a normal exit, turn the usual way of stopping a node into one
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Requests are handled in parallel threads, Blockchain does its own locking
+    app.run(host='0.0.0.0', port=port, threaded=True)
\ No newline at end of file
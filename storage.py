@@ -0,0 +1,414 @@
+from collections import OrderedDict
+import json
+import os
+import struct
+import threading
+import zlib
+
+from block import Block
+from utility.codec import VERSION, decode_block, encode_block
+
+# Number of appended blocks after which the segment file is flushed to disk with
+# fsync. Blocks that are written but not synced yet survive a crash of the node
+# process (they are in the OS cache) and can be fetched from peers again if the
+# whole machine goes down.
+FSYNC_BATCH = 10
+
+# Every entry in the index file is the byte offset of a block record stored as
+# an unsigned 8 byte big-endian integer.
+OFFSET_FORMAT = '>Q'
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+# The segment file starts with this marker, files without it are from the older
+# json format (one block per line) and get converted
+SEGMENT_MAGIC = 'BLOCKSEG{}\n'.format(VERSION).encode('ascii')
+# Segments of older versions of the binary format are converted as well
+OLD_SEGMENT_MAGICS = {'BLOCKSEG{}\n'.format(version).encode('ascii'): version for version in range(1, VERSION)}
+# Every block record is its length, the binary encoded block and a crc32 checksum
+# of the encoded block, so a partially written record can be detected
+RECORD_LENGTH = struct.Struct('>I')
+RECORD_CHECKSUM = struct.Struct('>I')
+
+# Number of blocks at the end of the chain that are always kept in memory
+RESIDENT_BLOCKS = 100
+# Number of older blocks that are kept in memory after they were paged in
+PAGED_BLOCKS = 50
+
+
+class Storage:
+    """ Persists the data of a node on disk.
+
+    Blocks are appended to a segment file (one binary record per block, see
+    utility/codec.py) and never rewritten, an index file holds the byte offset
+    of every block so single blocks can be read without parsing the whole
+    segment. Open transactions and peer nodes are small and change often, they
+    live in a separate json state file which is replaced atomically.
+
+    Attributes:
+        :blocks_path: The append-only block segment file.
+        :index_path: The file holding the offset of every block record.
+        :state_path: The file holding open transactions and peer nodes.
+        :legacy_path: The single-file format used by older versions.
+        :offsets (private): Byte offset of every block, position equals block index.
+        :unsynced (private): Number of appended blocks since the last fsync.
+    """
+
+    def __init__(self, node_id):
+        self.blocks_path = 'blockchain-{}.blocks'.format(node_id)
+        self.index_path = 'blockchain-{}.index'.format(node_id)
+        self.state_path = 'blockchain-{}.state'.format(node_id)
+        self.legacy_path = 'blockchain-{}.txt'.format(node_id)
+        self.__offsets = []
+        self.__unsynced = 0
+
+    def __len__(self):
+        return len(self.__offsets)
+
+    def recover(self):
+        """ Brings the files into a consistent state after startup (or a crash).
+
+        Loads the offset index, cuts off a partially written block at the end
+        of the segment and indexes any complete blocks the index is missing.
+        Only the blocks after the last indexed one are checked.
+        """
+        if not os.path.exists(self.blocks_path) and os.path.exists(self.legacy_path):
+            self.__import_legacy()
+        if not os.path.exists(self.blocks_path):
+            self.replace_blocks([])
+        with open(self.blocks_path, mode='rb') as f:
+            magic = f.read(len(SEGMENT_MAGIC))
+        if magic in OLD_SEGMENT_MAGICS:
+            self.__import_old_segment(OLD_SEGMENT_MAGICS[magic])
+        elif magic != SEGMENT_MAGIC:
+            self.__import_json_segment()
+        self.__offsets = self.__read_index()
+        size = os.path.getsize(self.blocks_path)
+        offsets = [offset for offset in self.__offsets if offset < size]
+        # The last indexed block could be the one which was torn, check it again
+        position = offsets.pop() if offsets else len(SEGMENT_MAGIC)
+        with open(self.blocks_path, mode='rb') as f:
+            f.seek(position)
+            while True:
+                record = self.__read_record(f)
+                if record is None:
+                    break
+                offsets.append(position)
+                position = f.tell()
+        if position < size:
+            print('Dropping incomplete block data at the end of {}'.format(self.blocks_path))
+            with open(self.blocks_path, mode='r+b') as f:
+                f.truncate(position)
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if offsets != self.__offsets or index_size != len(offsets) * OFFSET_SIZE:
+            self.__offsets = offsets
+            self.__write_index()
+
+    def read_blocks(self, start=0):
+        """ Yields the stored blocks one at a time.
+
+        Arguments:
+            :start: Index of the first block to read.
+        """
+        if start >= len(self.__offsets):
+            return
+        with open(self.blocks_path, mode='rb') as f:
+            f.seek(self.__offsets[start])
+            for _ in range(len(self.__offsets) - start):
+                yield decode_block(self.__read_record(f), trust_hash=True)[0]
+
+    def read_block(self, index):
+        """ Reads a single block by its index using the offset index. """
+        with open(self.blocks_path, mode='rb') as f:
+            f.seek(self.__offsets[index])
+            return decode_block(self.__read_record(f), trust_hash=True)[0]
+
+    def append_block(self, block):
+        """ Appends a block to the segment file.
+
+        Arguments:
+            :block: The block that should be stored.
+        """
+        record = self.__record(block)
+        with open(self.blocks_path, mode='ab') as f:
+            offset = f.tell()
+            f.write(record)
+            self.__unsynced += 1
+            if self.__unsynced >= FSYNC_BATCH:
+                f.flush()
+                os.fsync(f.fileno())
+        # The index entry is only written once the block itself is in the file
+        with open(self.index_path, mode='ab') as f:
+            f.write(struct.pack(OFFSET_FORMAT, offset))
+            if self.__unsynced >= FSYNC_BATCH:
+                f.flush()
+                os.fsync(f.fileno())
+                self.__unsynced = 0
+        self.__offsets.append(offset)
+
+    def replace_blocks(self, blocks):
+        """ Replaces all stored blocks, used when our chain is swapped for a
+        peer chain.
+
+        Arguments:
+            :blocks: The new chain as iterable of blocks.
+        """
+        offsets = []
+        tmp_path = self.blocks_path + '.tmp'
+        with open(tmp_path, mode='wb') as f:
+            f.write(SEGMENT_MAGIC)
+            for block in blocks:
+                offsets.append(f.tell())
+                f.write(self.__record(block))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.blocks_path)
+        self.__offsets = offsets
+        self.__write_index()
+        self.__unsynced = 0
+
+    def truncate(self, length):
+        """ Drops all blocks after the first length blocks, used when we switch
+        to a fork of the chain.
+
+        Arguments:
+            :length: The number of blocks to keep.
+        """
+        if length >= len(self.__offsets):
+            return
+        with open(self.blocks_path, mode='r+b') as f:
+            f.truncate(self.__offsets[length])
+            f.flush()
+            os.fsync(f.fileno())
+        self.__offsets = self.__offsets[:length]
+        self.__write_index()
+
+    def sync(self):
+        """ Forces all appended blocks to disk. """
+        if self.__unsynced == 0:
+            return
+        for path in (self.blocks_path, self.index_path):
+            with open(path, mode='ab') as f:
+                os.fsync(f.fileno())
+        self.__unsynced = 0
+
+    def load_state(self):
+        """ Returns the stored open transactions, peer nodes and the (height, hash)
+        of the last verified block (None if it wasn't stored yet).
+        """
+        if not os.path.exists(self.state_path):
+            return [], [], None
+        with open(self.state_path, mode='r') as f:
+            state = json.load(f)
+        verified = state.get('verified')
+        return state['open_transactions'], state['peer_nodes'], tuple(verified) if verified else None
+
+    def save_state(self, open_transactions, peer_nodes, verified=None):
+        """ Atomically replaces the state file.
+
+        Arguments:
+            :open_transactions: The open transactions as list of dictionaries.
+            :peer_nodes: The list of peer node urls.
+            :verified: (height, hash) of the block up to which the stored chain
+            was verified.
+        """
+        self.__write_atomic(self.state_path, json.dumps({
+            'open_transactions': open_transactions,
+            'peer_nodes': peer_nodes,
+            'verified': verified
+        }).encode('utf8'))
+
+    @staticmethod
+    def __record(block):
+        encoded = encode_block(block)
+        return RECORD_LENGTH.pack(len(encoded)) + encoded + RECORD_CHECKSUM.pack(zlib.crc32(encoded))
+
+    @staticmethod
+    def __read_record(f):
+        """ Reads the record at the current position of f and returns the encoded
+        block, or None if the record is incomplete or damaged.
+        """
+        length = f.read(RECORD_LENGTH.size)
+        if len(length) < RECORD_LENGTH.size:
+            return None
+        (length,) = RECORD_LENGTH.unpack(length)
+        encoded = f.read(length)
+        checksum = f.read(RECORD_CHECKSUM.size)
+        if len(encoded) < length or len(checksum) < RECORD_CHECKSUM.size:
+            return None
+        if RECORD_CHECKSUM.unpack(checksum)[0] != zlib.crc32(encoded):
+            return None
+        return encoded
+
+    def __read_index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, mode='rb') as f:
+            data = f.read()
+        # A partially written entry at the end is ignored and rebuilt by recover()
+        usable = len(data) - len(data) % OFFSET_SIZE
+        return [offset for (offset,) in struct.iter_unpack(OFFSET_FORMAT, data[:usable])]
+
+    def __write_index(self):
+        self.__write_atomic(self.index_path, b''.join(
+            struct.pack(OFFSET_FORMAT, offset) for offset in self.__offsets))
+
+    def __write_atomic(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode='wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def __import_legacy(self):
+        """ Converts the old single-file format (chain, open transactions and
+        peer nodes as json, one per line) into the new files.
+        """
+        with open(self.legacy_path, mode='r') as f:
+            file_content = f.readlines()
+        self.replace_blocks(Block.from_dict(block) for block in json.loads(file_content[0]))
+        open_transactions = json.loads(file_content[1]) if len(file_content) > 1 else []
+        peer_nodes = json.loads(file_content[2]) if len(file_content) > 2 else []
+        self.save_state(open_transactions, peer_nodes)
+
+    def __import_old_segment(self, version):
+        """ Converts a segment file of an older version of the binary format,
+        a damaged record at the end is dropped.
+
+        Arguments:
+            :version: The version of the binary format the segment was written with.
+        """
+        blocks = []
+        with open(self.blocks_path, mode='rb') as f:
+            f.seek(len(SEGMENT_MAGIC))
+            record = self.__read_record(f)
+            while record is not None:
+                blocks.append(decode_block(record, trust_hash=True, version=version)[0])
+                record = self.__read_record(f)
+        self.replace_blocks(blocks)
+
+    def __import_json_segment(self):
+        """ Converts a segment file of the json format (one block per line) into
+        the binary format, a torn last line is dropped.
+        """
+        blocks = []
+        with open(self.blocks_path, mode='rb') as f:
+            for line in f:
+                try:
+                    block = json.loads(line)
+                except ValueError:
+                    break
+                # Our own file, the stored hash can be trusted
+                blocks.append(Block.from_dict(block, block.get('hash')))
+        self.replace_blocks(blocks)
+
+
+class LazyChain:
+    """ A list-like sequence of blocks which keeps only the header (everything
+    but the transactions) of every block in memory, plus the full most recent
+    blocks. Older blocks are paged in from the storage when they are accessed.
+
+    Any number of threads may read at the same time, but changing the chain
+    (load, append, truncate, replace) must not overlap with reads. Blockchain
+    makes sure of that with its read-write lock.
+
+    Attributes:
+        :storage (private): The storage the blocks are paged in from.
+        :headers (private): The header dictionary of every block.
+        :blocks (private): The resident blocks by index.
+        :paged (private): Recently paged in older blocks, least recently used first.
+        :paged_lock (private): Guards paged, reading a block changes it and
+        several threads may read at the same time.
+    """
+
+    def __init__(self, storage):
+        self.__storage = storage
+        self.__headers = []
+        self.__blocks = {}
+        self.__paged = OrderedDict()
+        self.__paged_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__headers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('block index out of range')
+        if index in self.__blocks:
+            return self.__blocks[index]
+        with self.__paged_lock:
+            if index in self.__paged:
+                self.__paged.move_to_end(index)
+                return self.__paged[index]
+        block = self.__storage.read_block(index)
+        with self.__paged_lock:
+            self.__paged[index] = block
+            if len(self.__paged) > PAGED_BLOCKS:
+                self.__paged.popitem(last=False)
+        return block
+
+    def __iter__(self):
+        return self.iter_range(0, len(self))
+
+    def iter_range(self, start, stop):
+        """ Yields the blocks from index start up to (excluding) stop. Older
+        blocks are read sequentially from the segment instead of one seek each.
+        """
+        stop = min(stop, len(self))
+        first_resident = min(self.__blocks) if self.__blocks else len(self)
+        position = max(start, 0)
+        if position < min(first_resident, stop):
+            for block in self.__storage.read_blocks(position):
+                yield block
+                position += 1
+                if position == min(first_resident, stop):
+                    break
+        for index in range(position, stop):
+            yield self[index]
+
+    def header(self, index):
+        """ Returns the header dictionary of a block without paging it in. """
+        return self.__headers[index]
+
+    def load(self, block):
+        """ Adds a block which was read from the storage while loading.
+
+        Arguments:
+            :block: The next block of the stored chain.
+        """
+        self.__headers.append(block.header())
+        # Only keep the body if it is going to be one of the resident blocks
+        if len(self.__headers) > len(self.__storage) - RESIDENT_BLOCKS:
+            self.__blocks[len(self.__headers) - 1] = block
+
+    def append(self, block):
+        """ Adds a new block to the end of the chain. The block has to be written
+        to the storage before it is evicted from memory.
+
+        Arguments:
+            :block: The block that should be appended.
+        """
+        self.__headers.append(block.header())
+        self.__blocks[len(self.__headers) - 1] = block
+        # The resident blocks are always the tail of the chain, drop the oldest one
+        self.__blocks.pop(len(self.__headers) - 1 - RESIDENT_BLOCKS, None)
+
+    def truncate(self, length):
+        """ Drops all blocks after the first length blocks. """
+        self.__headers = self.__headers[:length]
+        self.__blocks = {index: block for (index, block) in self.__blocks.items() if index < length}
+        with self.__paged_lock:
+            self.__paged = OrderedDict(
+                (index, block) for (index, block) in self.__paged.items() if index < length)
+
+    def replace(self, blocks):
+        """ Replaces all blocks with the given list of blocks. """
+        self.__headers = [block.header() for block in blocks]
+        first_resident = max(len(blocks) - RESIDENT_BLOCKS, 0)
+        self.__blocks = {index: blocks[index] for index in range(first_resident, len(blocks))}
+        with self.__paged_lock:
+            self.__paged = OrderedDict()
\ No newline at end of file
@@ -9,18 +9,61 @@ class Transaction(Printable):
         :recipient: The recipient of the coins.
         :signature: The signature of the transaction:
         :amount: The amount of coins sent.
+        :nonce: Random value which is signed along, so paying the same amount to
+        the same recipient twice gives two different transactions. None for
+        transactions created by older versions.
+        :fee: The amount the sender pays to the miner on top of amount, blocks
+        are filled with the transactions paying the highest fees first.
     """
 
+    # Fixed attributes instead of a per-instance __dict__, a long chain holds a lot of transactions
+    __slots__ = ('sender', 'recipient', 'amount', 'signature', 'nonce', 'fee')
 
-    def __init__(self, sender, recipient, signature, amount):
+
+    def __init__(self, sender, recipient, signature, amount, nonce=None, fee=0):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount
         self.signature = signature
+        self.nonce = nonce
+        self.fee = fee
+
+
+    def get_total(self):
+        """ Returns what the transaction costs the sender (amount plus fee). """
+        return self.amount + self.fee
 
 
     # Creating an ordered dict out of a given transaction. Used when order matters.
     def to_ordered_dict(self):
-        return OrderedDict([('sender', self.sender), 
-                            ('recipient', self.recipient), 
-                            ('amount', self.amount)])
\ No newline at end of file
+        fields = [('sender', self.sender), 
+                  ('recipient', self.recipient), 
+                  ('amount', self.amount)]
+        # Left out if not set so older transactions keep their hashes
+        if self.nonce is not None:
+            fields.append(('nonce', self.nonce))
+        if self.fee:
+            fields.append(('fee', self.fee))
+        return OrderedDict(fields)
+
+
+    def to_dict(self):
+        """ Returns the transaction (including its signature) as dictionary that can be dumped using json. """
+        tx = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount,
+            'signature': self.signature
+        }
+        if self.nonce is not None:
+            tx['nonce'] = self.nonce
+        if self.fee:
+            tx['fee'] = self.fee
+        return tx
+
+
+    @staticmethod
+    def from_dict(tx):
+        """ Creates a transaction from a dictionary. """
+        return Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'],
+                           tx.get('nonce'), tx.get('fee', 0))
\ No newline at end of file
@@ -0,0 +1,123 @@
+import os
+import struct
+
+from utility.hash_util import hash_transaction
+
+# Every block gets a record: its height and the number of entries, followed by
+# the id and the position in the block of each of its transactions
+BLOCK_RECORD = struct.Struct('>QI')
+ENTRY_RECORD = struct.Struct('>32sI')
+
+
+class TransactionIndex:
+    """ Maps the id of every confirmed transaction to the block it is in.
+
+    The index is written to its own file as blocks are appended, so it doesn't
+    have to be rebuilt on startup. It only holds data derived from the chain:
+    it is always kept a prefix of the stored chain and blocks it is missing
+    (e.g. after a crash) are simply indexed again. Reward transactions are not
+    indexed, they are the same for every block a miner mines.
+
+    Attributes:
+        :path: The file the index is stored in.
+        :locations (private): Transaction id (raw bytes) -> (block height, position in block).
+        :offsets (private): Byte offset of the record of every indexed block.
+    """
+
+    def __init__(self, node_id):
+        self.path = 'blockchain-{}.txids'.format(node_id)
+        self.__locations = {}
+        self.__offsets = []
+
+    def __len__(self):
+        """ Returns the number of indexed blocks. """
+        return len(self.__offsets)
+
+    def __contains__(self, txid):
+        return bytes.fromhex(txid) in self.__locations
+
+    def load(self):
+        """ Reads the index file, a partially written record at the end is dropped. """
+        self.__locations = {}
+        self.__offsets = []
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='rb') as f:
+            data = f.read()
+        position = 0
+        while position + BLOCK_RECORD.size <= len(data):
+            height, count = BLOCK_RECORD.unpack_from(data, position)
+            end = position + BLOCK_RECORD.size + count * ENTRY_RECORD.size
+            if height != len(self.__offsets) or end > len(data):
+                break
+            for (txid, index) in ENTRY_RECORD.iter_unpack(data[position + BLOCK_RECORD.size:end]):
+                self.__locations[txid] = (height, index)
+            self.__offsets.append(position)
+            position = end
+        if position < len(data):
+            with open(self.path, mode='r+b') as f:
+                f.truncate(position)
+
+    def add_block(self, block):
+        """ Indexes the transactions of the next block of the chain.
+
+        Arguments:
+            :block: The block that was appended to the chain.
+        """
+        with open(self.path, mode='ab') as f:
+            self.__offsets.append(f.tell())
+            f.write(self.__index(block))
+
+    def replace(self, blocks):
+        """ Rebuilds the index for a new chain.
+
+        Arguments:
+            :blocks: The new chain as iterable of blocks.
+        """
+        self.__locations = {}
+        self.__offsets = []
+        with open(self.path, mode='wb') as f:
+            for block in blocks:
+                self.__offsets.append(f.tell())
+                f.write(self.__index(block))
+
+    def truncate(self, length):
+        """ Drops the transactions of all blocks after the first length blocks.
+
+        Arguments:
+            :length: The number of blocks to keep.
+        """
+        if length >= len(self.__offsets):
+            return
+        with open(self.path, mode='r+b') as f:
+            f.seek(self.__offsets[length])
+            data = f.read()
+            f.truncate(self.__offsets[length])
+        position = 0
+        while position < len(data):
+            _, count = BLOCK_RECORD.unpack_from(data, position)
+            position += BLOCK_RECORD.size
+            for _ in range(count):
+                self.__locations.pop(ENTRY_RECORD.unpack_from(data, position)[0], None)
+                position += ENTRY_RECORD.size
+        self.__offsets = self.__offsets[:length]
+
+    def __index(self, block):
+        """ Adds the transactions of a block to the lookup table and returns its record. """
+        entries = [(bytes.fromhex(hash_transaction(tx)), index)
+                   for (index, tx) in enumerate(block.transactions) if tx.sender != 'MINING']
+        for (txid, index) in entries:
+            self.__locations[txid] = (block.index, index)
+        return BLOCK_RECORD.pack(block.index, len(entries)) + b''.join(
+            ENTRY_RECORD.pack(txid, index) for (txid, index) in entries)
+
+    def get_location(self, txid):
+        """ Returns (block height, position in block) of a confirmed transaction or None.
+
+        Arguments:
+            :txid: The transaction id as hex string.
+        """
+        try:
+            return self.__locations.get(bytes.fromhex(txid))
+        except ValueError:
+            return None
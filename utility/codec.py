@@ -0,0 +1,174 @@
+""" Compact binary encoding of blocks and transactions.
+
+Keys and signatures are hex strings in the json format, here they are stored as
+raw bytes which halves their size. Every string is written as a type byte and a
+length prefix, numbers have a fixed width. Numbers keep their type (1 and 1.0)
+because that changes the signed payload and the block hash.
+
+Version 2 added the transaction nonce, version 3 the fee, version 4 the block
+difficulty and version 5 the Merkle root, data of older versions can still be
+decoded.
+"""
+
+import struct
+
+from block import Block
+from transaction import Transaction
+
+# Version of the encoding written by this module
+VERSION = 5
+# Content type used for the binary format on the wire
+MIMETYPE = 'application/vnd.blockchain.v{}+binary'.format(VERSION)
+
+# Type bytes of strings
+_TEXT = 0
+_HEX = 1
+_NONE = 2
+# Type bytes of numbers
+_INT = 0
+_FLOAT = 1
+
+_BYTE = struct.Struct('>B')
+_LENGTH = struct.Struct('>I')
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+_BLOCK = struct.Struct('>QQ')
+
+
+def _pack_string(value):
+    if value is None:
+        return _BYTE.pack(_NONE)
+    try:
+        raw = bytes.fromhex(value)
+        # Only use raw bytes if converting back gives the exact same string
+        if raw.hex() != value:
+            raise ValueError()
+        kind = _HEX
+    except ValueError:
+        raw = value.encode('utf8')
+        kind = _TEXT
+    return _BYTE.pack(kind) + _LENGTH.pack(len(raw)) + raw
+
+
+def _unpack_string(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == _NONE:
+        return None, offset
+    (length,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    raw = data[offset:offset + length]
+    offset += length
+    if kind == _HEX:
+        return raw.hex(), offset
+    return raw.decode('utf8'), offset
+
+
+def _pack_number(value):
+    if isinstance(value, int):
+        return _BYTE.pack(_INT) + _INT64.pack(value)
+    return _BYTE.pack(_FLOAT) + _FLOAT64.pack(value)
+
+
+def _unpack_number(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+
+
+def encode_transaction(transaction):
+    """ Returns the binary encoding of a transaction. """
+    return b''.join((
+        _pack_string(transaction.sender),
+        _pack_string(transaction.recipient),
+        _pack_number(transaction.amount),
+        _pack_string(transaction.signature),
+        _pack_string(transaction.nonce),
+        _pack_number(transaction.fee)
+    ))
+
+
+def decode_transaction(data, offset=0, version=VERSION):
+    """ Decodes a transaction starting at offset, returns (transaction, offset after it). """
+    sender, offset = _unpack_string(data, offset)
+    recipient, offset = _unpack_string(data, offset)
+    amount, offset = _unpack_number(data, offset)
+    signature, offset = _unpack_string(data, offset)
+    nonce = None
+    if version >= 2:
+        nonce, offset = _unpack_string(data, offset)
+    fee = 0
+    if version >= 3:
+        fee, offset = _unpack_number(data, offset)
+    return Transaction(sender, recipient, signature, amount, nonce, fee), offset
+
+
+def encode_block(block):
+    """ Returns the binary encoding of a block including its transactions. """
+    parts = [
+        _BLOCK.pack(block.index, block.proof),
+        # Difficulties are at least 1, 0 stands for blocks of older versions without one
+        _BYTE.pack(block.difficulty or 0),
+        _pack_string(block.previous_hash),
+        _pack_number(block.timestamp),
+        _pack_string(block.hash),
+        _pack_string(block.merkle_root),
+        _LENGTH.pack(len(block.transactions))
+    ]
+    parts.extend(encode_transaction(tx) for tx in block.transactions)
+    return b''.join(parts)
+
+
+def decode_block(data, offset=0, trust_hash=False, version=VERSION):
+    """ Decodes a block starting at offset, returns (block, offset after it).
+
+    Arguments:
+        :data: The encoded bytes.
+        :offset: Position of the block in data.
+        :trust_hash: Keep the encoded hash, only for data we wrote ourselves.
+        A hash received from a peer can't be trusted.
+        :version: The version of the encoding the data was written with.
+    """
+    index, proof = _BLOCK.unpack_from(data, offset)
+    offset += _BLOCK.size
+    difficulty = None
+    if version >= 4:
+        difficulty = data[offset] or None
+        offset += 1
+    previous_hash, offset = _unpack_string(data, offset)
+    timestamp, offset = _unpack_number(data, offset)
+    block_hash, offset = _unpack_string(data, offset)
+    merkle_root = None
+    if version >= 5:
+        merkle_root, offset = _unpack_string(data, offset)
+    (count,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    transactions = []
+    for _ in range(count):
+        transaction, offset = decode_transaction(data, offset, version)
+        transactions.append(transaction)
+    block = Block(index, previous_hash, transactions, proof, timestamp,
+                  block_hash if trust_hash else None, difficulty, merkle_root)
+    return block, offset
+
+
+def encode_blocks(blocks):
+    """ Yields a list of blocks as length-prefixed records, so it can be streamed. """
+    for block in blocks:
+        record = encode_block(block)
+        yield _LENGTH.pack(len(record)) + record
+
+
+def decode_blocks(data):
+    """ Decodes the output of encode_blocks() into a list of blocks (hashes are dropped). """
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        block, _ = decode_block(data, offset)
+        blocks.append(block)
+        offset += length
+    return blocks
@@ -1,5 +1,42 @@
 import hashlib as hl
 import json
+import struct
+
+# Fixed-size header of blocks with a Merkle root: index, previous hash, timestamp,
+# Merkle root and difficulty, followed by the proof. The proof comes last so a
+# proof search only has to hash the rest once.
+_HEADER = struct.Struct('>Q32sd32sB')
+_PROOF = struct.Struct('>Q')
+
+
+def _raw_hash(value):
+    raw = bytes.fromhex(value)
+    if len(raw) != 32:
+        raise ValueError('not a sha256 hash')
+    return raw
+
+
+def pack_header_prefix(block):
+    """ Returns the fixed-size header of a block with a Merkle root without the
+    proof. Raises a ValueError if a field doesn't fit (e.g. a malformed block
+    received from a peer).
+
+    Arguments:
+        :block: The block, its transactions are only included through the Merkle root.
+    """
+    try:
+        return _HEADER.pack(block.index, _raw_hash(block.previous_hash), block.timestamp,
+                            _raw_hash(block.merkle_root), block.difficulty)
+    except (struct.error, TypeError) as e:
+        raise ValueError('Malformed block header: {}'.format(e))
+
+
+def pack_proof(proof):
+    """ Returns the proof part of the fixed-size header (see pack_header_prefix()). """
+    try:
+        return _PROOF.pack(proof)
+    except struct.error as e:
+        raise ValueError('Malformed block header: {}'.format(e))
 
 
 def hash_string_256(string):
@@ -17,13 +54,25 @@ def hash_block(block):
     Arguments:
         :block: The block that should be hashed.
     """
+    # Blocks which are part of the chain can't change, their hash is only calculated once
+    if block.hash is not None:
+        return block.hash
+    # The hash of a block with a Merkle root costs the same no matter how many transactions it has,
+    # it is also the hash its proof of work is checked against
+    if block.merkle_root is not None:
+        return hl.sha256(pack_header_prefix(block) + pack_proof(block.proof)).hexdigest()
     # Creates a dictionary version of the block so that it can be processed by json.
-    # Must use '.copy()' to create a new copy of the dictionary every time as not to disturb
-    # the reference.  
-    hashable_block = block.__dict__.copy()
+    # The hash attribute itself is not part of what gets hashed.
+    hashable_block = block.header()
+    del hashable_block['hash']
+    # Only blocks of older versions get here, they are hashed with all their transactions
+    del hashable_block['merkle_root']
+    # Blocks of older versions don't have a difficulty, their hashes stay the same
+    if hashable_block['difficulty'] is None:
+        del hashable_block['difficulty']
 
     # Access the list of transaction objects in the given block and convert to ordered dictionaries
-    hashable_block['transactions'] = [tx.to_ordered_dict() for tx in hashable_block['transactions']]
+    hashable_block['transactions'] = [tx.to_ordered_dict() for tx in block.transactions]
 
     # hashlib.sha256() creates a 64 character hash on a string
     # json.dumps() creates a json string from an object using sort_keys to
@@ -31,3 +80,12 @@ def hash_block(block):
     # with dictionaries
     # encode() encodes the json string as 'utf-8' which is needed for sha256
     return hash_string_256(json.dumps(hashable_block, sort_keys = True).encode())
+
+
+def hash_transaction(transaction):
+    """Returns the id of a transaction, the hash of all its fields (including the signature).
+
+    Arguments:
+        :transaction: The transaction that should be hashed.
+    """
+    return hash_string_256(json.dumps(transaction.to_dict(), sort_keys = True).encode())
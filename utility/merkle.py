@@ -0,0 +1,84 @@
+""" Merkle tree over the transaction ids of a block.
+
+The leaves are the raw transaction ids in block order. Every inner node is the
+sha256 of a marker byte and its two children, the marker keeps an inner node
+from ever being passed off as a transaction id. A node without a sibling is
+moved up a level unchanged instead of being paired with itself, so two
+different lists of transactions never have the same root.
+
+A Merkle proof is the list of sibling hashes from a transaction up to the root,
+with it a light client can check that a transaction is part of a block knowing
+only the block header.
+"""
+
+import hashlib as hl
+
+# Prefix of the hashed data of inner nodes
+_NODE = b'\x01'
+# Root of a block without transactions
+EMPTY_ROOT = bytes(32).hex()
+
+
+def _parent(left, right):
+    return hl.sha256(_NODE + left + right).digest()
+
+
+def get_merkle_root(txids):
+    """ Returns the Merkle root (hex) of a list of transaction ids.
+
+    Arguments:
+        :txids: The ids of the transactions of a block in block order (see hash_transaction()).
+    """
+    if not txids:
+        return EMPTY_ROOT
+    level = [bytes.fromhex(txid) for txid in txids]
+    while len(level) > 1:
+        # An odd node at the end moves up unchanged
+        level = [_parent(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+def get_merkle_proof(txids, position):
+    """ Returns the Merkle proof of a transaction, a list of [side, hash] pairs
+    from the transaction up to the root. Side is 'left' or 'right', the side the
+    sibling hash is on.
+
+    Arguments:
+        :txids: The ids of the transactions of a block in block order.
+        :position: The position of the transaction in the block.
+    """
+    proof = []
+    level = [bytes.fromhex(txid) for txid in txids]
+    while len(level) > 1:
+        if position % 2 == 1:
+            proof.append(['left', level[position - 1].hex()])
+        elif position + 1 < len(level):
+            proof.append(['right', level[position + 1].hex()])
+        level = [_parent(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(txid, proof, merkle_root):
+    """ Checks a Merkle proof from get_merkle_proof(), returns True if the
+    transaction is part of the block with that Merkle root.
+
+    Arguments:
+        :txid: The id of the transaction.
+        :proof: The [side, hash] pairs of the proof.
+        :merkle_root: The Merkle root stored in the block header.
+    """
+    try:
+        node = bytes.fromhex(txid)
+        for (side, sibling) in proof:
+            if side == 'left':
+                node = _parent(bytes.fromhex(sibling), node)
+            elif side == 'right':
+                node = _parent(node, bytes.fromhex(sibling))
+            else:
+                return False
+    except (TypeError, ValueError):
+        return False
+    return node.hex() == merkle_root
@@ -1,4 +1,7 @@
 class Printable:
-    """Base class implementing printing"""
+    """Base class implementing printing, subclasses provide to_dict()"""
+    # Empty so subclasses using __slots__ don't get a __dict__ anyway
+    __slots__ = ()
+
     def __repr__(self):
-        return str(self.__dict__)
\ No newline at end of file
+        return str(self.to_dict())
\ No newline at end of file
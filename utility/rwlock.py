@@ -0,0 +1,94 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """ A lock which can be held by any number of readers at the same time or
+    by a single writer.
+
+    Writers are preferred: once a writer waits, new readers wait as well, so a
+    steady stream of reads can't starve it. Both sides are reentrant, a thread
+    holding the write lock may also read, and a thread that is already reading
+    may read again without waiting for a queued writer (which would deadlock).
+    Upgrading a read to a write is not possible.
+
+    Attributes:
+        :condition (private): Guards the counters below, waiting threads sleep on it.
+        :readers (private): Number of threads holding the read lock.
+        :writer (private): The thread holding the write lock or None.
+        :writes (private): How often the writer acquired the write lock.
+        :waiting_writers (private): Number of threads waiting for the write lock.
+        :local (private): Per thread number of acquired read locks.
+    """
+
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = None
+        self.__writes = 0
+        self.__waiting_writers = 0
+        self.__local = threading.local()
+
+    @contextmanager
+    def read(self):
+        """ Holds the read lock for the duration of a with block. """
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """ Holds the write lock for the duration of a with block. """
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def acquire_read(self):
+        reads = getattr(self.__local, 'reads', 0)
+        if reads > 0 or self.__writer is threading.current_thread():
+            # Already inside the lock, waiting here could only deadlock
+            self.__local.reads = reads + 1
+            return
+        with self.__condition:
+            while self.__writer is not None or self.__waiting_writers > 0:
+                self.__condition.wait()
+            self.__readers += 1
+        self.__local.reads = 1
+
+    def release_read(self):
+        self.__local.reads -= 1
+        if self.__local.reads > 0 or self.__writer is threading.current_thread():
+            return
+        with self.__condition:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        if self.__writer is me:
+            self.__writes += 1
+            return
+        if getattr(self.__local, 'reads', 0) > 0:
+            raise RuntimeError('a read lock can not be upgraded to a write lock')
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writer is not None or self.__readers > 0:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writer = me
+            self.__writes = 1
+
+    def release_write(self):
+        if self.__writer is not threading.current_thread():
+            raise RuntimeError('the write lock is not held by this thread')
+        self.__writes -= 1
+        if self.__writes > 0:
+            return
+        with self.__condition:
+            self.__writer = None
+            self.__condition.notify_all()
@@ -1,16 +1,218 @@
 """ Provides verification helper methods. """
 
-from utility.hash_util import hash_string_256, hash_block
+import hashlib as hl
+import math
+import multiprocessing
+from collections import deque
+from functools import partial
+from time import perf_counter, time
+
+from block import Block
+from difficulty import BLOCK_TIME, RETARGET_INTERVAL, get_target, valid_difficulty, valid_timestamp
+from utility.hash_util import hash_block, hash_transaction, pack_header_prefix, pack_proof
+from utility.merkle import get_merkle_root
 from wallet import Wallet
 
+# Batches with fewer unverified transactions than this are checked in-process,
+# handing them to the pool would cost more than it saves
+PARALLEL_VERIFY_THRESHOLD = 16
+
+# Number of blocks a chain verification hands to a pool worker at once
+VERIFY_SHARD_BLOCKS = 500
+
+# Integers are stored as signed 64 bit numbers in the binary format (see utility/codec.py)
+MAX_INT = 2 ** 63 - 1
+
+# Worker processes for signature verification, created on first use (or up front,
+# see Verification.start_pool())
+_verify_pool = None
+_verify_pool_size = 0
+
+
+def _get_verify_pool(processes):
+    """ Returns the shared verification pool, (re)creating it if the size changed. """
+    global _verify_pool, _verify_pool_size
+    if _verify_pool is None or _verify_pool_size != processes:
+        if _verify_pool is not None:
+            _verify_pool.terminate()
+        _verify_pool = multiprocessing.Pool(processes)
+        _verify_pool_size = processes
+    return _verify_pool
+
+
+def _valid_number(value):
+    """ Returns True for a finite int or float the binary format can store. """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -MAX_INT - 1 <= value <= MAX_INT
+    return isinstance(value, float) and math.isfinite(value)
+
+
+def _verify_shard(blocks):
+    """ Calculates the hashes of a run of consecutive blocks and checks their
+    proofs, runs in the pool workers. The links between the blocks and their
+    difficulties are checked by the caller once the hashes of all shards are known.
+
+    Returns the hashes and the position of the first block with an invalid
+    proof (or a stored hash or Merkle root which doesn't match its content),
+    None if there is none. Hashes are only returned up to that block.
+    """
+    hashes = []
+    for (position, block) in enumerate(blocks):
+        try:
+            # A hash stored with the block isn't trusted, it is calculated again from a copy
+            calculated = hash_block(block if block.hash is None else Block(
+                block.index, block.previous_hash, block.transactions, block.proof, block.timestamp,
+                difficulty=block.difficulty, merkle_root=block.merkle_root))
+        except ValueError:
+            hashes.append(None)
+            return hashes, position
+        hashes.append(calculated)
+        if block.hash is not None and block.hash != calculated:
+            return hashes, position
+        if not Verification.valid_merkle_root(block) or not Verification.valid_block_proof(block, calculated):
+            return hashes, position
+    return hashes, None
+
+
+class ChainVerifier:
+    """ Verifies the blocks following a trusted block, which are added one at
+    a time (e.g. while they are read from disk).
+
+    The blocks are split into shards of VERIFY_SHARD_BLOCKS blocks. With more
+    than one process a shard is handed to the pool as soon as it is full, so
+    the workers calculate hashes and check proofs while the caller goes on
+    reading blocks. The indexes, the links between the blocks (the
+    previous_hash of each block is the hash of the block before it) and the
+    difficulties and timestamps (which depend on the timestamps of the blocks
+    before) are checked at the end, as well as that no block of an older
+    version (without a Merkle root) follows a block with a Merkle root.
+
+    Attributes:
+        :processes (private): Number of worker processes, 1 verifies in-process.
+        :height (private): Height of the trusted block.
+        :trusted_hash (private): The hash of the trusted block.
+        :trusted_difficulty (private): The difficulty of the trusted block.
+        :trusted_merkle (private): Whether the trusted block has a Merkle root.
+        :timestamps (private): Timestamps of the trusted block and the blocks before
+        it (passed by the caller, oldest first), the difficulty of the next blocks
+        depends on them.
+        :block_time (private): Targeted number of seconds between two blocks.
+        :pending (private): Blocks of the shard which isn't full yet.
+        :shards (private): Per shard the indexes, previous hashes, timestamps, difficulties
+        and whether there is a Merkle root stored in its blocks and the result of _verify_shard() (pending in the pool
+        if processes > 1).
+    """
+
+    def __init__(self, trusted_block, height, processes=1, timestamps=(), block_time=BLOCK_TIME):
+        self.__processes = processes
+        self.__height = height
+        self.__trusted_hash = hash_block(trusted_block)
+        self.__trusted_difficulty = trusted_block.difficulty
+        self.__trusted_merkle = trusted_block.merkle_root is not None
+        self.__timestamps = list(timestamps)[-(RETARGET_INTERVAL - 1):] + [trusted_block.timestamp]
+        self.__block_time = block_time
+        self.__pending = []
+        self.__shards = []
+
+    def add(self, block):
+        """ Adds the next block of the chain. """
+        self.__pending.append(block)
+        if len(self.__pending) >= VERIFY_SHARD_BLOCKS:
+            self.__submit()
+
+    def __submit(self):
+        blocks = self.__pending
+        self.__pending = []
+        headers = [(block.index, block.previous_hash, block.timestamp, block.difficulty,
+                    block.merkle_root is not None) for block in blocks]
+        if self.__processes > 1:
+            result = _get_verify_pool(self.__processes).apply_async(_verify_shard, (blocks,))
+        else:
+            result = _verify_shard(blocks)
+        self.__shards.append((headers, result))
+
+    def get_first_invalid(self):
+        """ Waits for all shards and returns the height of the first invalid
+        block, or None if all added blocks are valid.
+        """
+        if self.__pending:
+            self.__submit()
+        height = self.__height + 1
+        previous_hash = self.__trusted_hash
+        previous_difficulty = self.__trusted_difficulty
+        previous_merkle = self.__trusted_merkle
+        timestamps = deque(self.__timestamps, maxlen=RETARGET_INTERVAL)
+        now = time()
+        for (headers, result) in self.__shards:
+            hashes, invalid = result.get() if self.__processes > 1 else result
+            for (position, block_hash) in enumerate(hashes):
+                index, block_previous_hash, timestamp, difficulty, merkle = headers[position]
+                if index != height or block_previous_hash != previous_hash or position == invalid:
+                    return height
+                if previous_merkle and not merkle:
+                    return height
+                if not valid_timestamp(timestamp, timestamps, now):
+                    return height
+                if not valid_difficulty(difficulty, height, previous_difficulty, timestamps, self.__block_time):
+                    return height
+                previous_hash = block_hash
+                previous_difficulty = difficulty
+                previous_merkle = merkle
+                timestamps.append(timestamp)
+                height += 1
+        return None
+
 
 class Verification:
     """ A helper class which offers various statis and class-based verification methods. """
-    # Using staticmethod decorator since it isn't accessing anything from inside the class
+    # Using classmethod decorator since it uses the proof helpers below
+    @classmethod
+    def valid_block_proof(cls, block, block_hash=None):
+        """ Checks the proof of work of a block. For a block with a Merkle root
+        its hash has to be below the target, blocks of older versions are checked
+        with valid_proof().
+
+        Arguments:
+            :block: The block to check.
+            :block_hash: The hash of the block if it was already calculated.
+        """
+        if block.merkle_root is None:
+            # Excluding reward transactions since the reward transaction is included
+            # after the proof of work
+            return cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof, block.difficulty)
+        try:
+            if block_hash is None:
+                block_hash = hash_block(block)
+            return bytes.fromhex(block_hash) < get_target(block.difficulty)
+        except ValueError:
+            return False
+
+
+    # Method only working with the inputs its given
     @staticmethod
-    def valid_proof(transactions, last_hash, proof):
+    def valid_merkle_root(block, txids=None):
+        """ Checks that the Merkle root of a block matches its transactions,
+        blocks of older versions don't have one.
+
+        Arguments:
+            :block: The block to check.
+            :txids: The ids of its transactions if they were already calculated.
+        """
+        if block.merkle_root is None:
+            return True
+        if txids is None:
+            txids = [hash_transaction(tx) for tx in block.transactions]
+        return block.merkle_root == get_merkle_root(txids)
+
+
+    # Using classmethod decorator since it uses the prepared proof helpers below
+    @classmethod
+    def valid_proof(cls, transactions, last_hash, proof, difficulty=None):
         """ Generates a valid new hashes by checking to see if it fits our difficulty criteria.
-        In our case its two leading 0's. Ideally this would get harder with time.
+        In our case a number of leading zero bits which is adjusted to the block time.
+        Only used for blocks of older versions (without a Merkle root).
 
         Arguments:
             :transactions: Transactions of new block for which the proof
@@ -18,38 +220,202 @@ class Verification:
             :last_hash: Hash of previous block in the blockchain, will be
             stored in the current block
             :proof: Proof number
+            :difficulty: Number of leading zero bits, None for blocks of older versions
+        """
+        return cls.valid_prepared_proof(
+            cls.prepare_proof(transactions, last_hash), proof, get_target(difficulty))
+
+
+    @staticmethod
+    def prepare_proof(transactions, last_hash):
+        """ Returns a sha256 object which already consumed everything of a proof
+        guess except the proof number. Searching a proof only needs to serialize
+        the transactions once and can copy this object for every guess.
+
+        Arguments:
+            :transactions: Transactions of new block for which the proof
+            is created
+            :last_hash: Hash of previous block in the blockchain
         """
         # Hash not the same as the previous hash since index is not considered.
         # The string is encoded into 'utf-8' characters.
         # IMPORTANT this converts transactions, which is an ordered dict. This means it is 
         #           is converted into a string with '[OrderedDict()]' at the start of the
         #           the list of transactions
-        guess = (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode()
-        # Calculate hash of new guess using custom function defined in hash_util
-        guess_hash = hash_string_256(guess)
-        # Only a hash (which is based on the above inputs) which starts with two 00's is a valid hash.
-        # This is the hash difficulty and can be changed to be more difficult.
-        return guess_hash[0:2] == '00'
+        return hl.sha256((str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)).encode())
+
+
+    @staticmethod
+    def valid_prepared_proof(prepared, proof, target):
+        """ Checks a proof number against a hash object from prepare_proof().
+
+        Arguments:
+            :prepared: The sha256 object returned by prepare_proof()
+            :proof: Proof number
+            :target: The target of the difficulty (see difficulty.get_target()),
+            looked up once instead of for every guess
+        """
+        guess = prepared.copy()
+        guess.update(str(proof).encode())
+        # Only a hash (which is based on the above inputs) below the target is a valid hash,
+        # i.e. the raw digest starts with as many zero bits as the difficulty asks for.
+        return guess.digest() < target
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def prepare_header(block):
+        """ Returns a sha256 object which already consumed the header of a block
+        with a Merkle root except the proof, the counterpart of prepare_proof().
+        Every guess only hashes the proof on top, no matter how many
+        transactions the block has.
+
+        Arguments:
+            :block: The block whose proof is searched.
+        """
+        return hl.sha256(pack_header_prefix(block))
+
+
+    @staticmethod
+    def valid_prepared_header(prepared, proof, target):
+        """ Checks a proof number against a hash object from prepare_header().
+
+        Arguments:
+            :prepared: The sha256 object returned by prepare_header()
+            :proof: Proof number
+            :target: The target of the difficulty (see difficulty.get_target())
+        """
+        guess = prepared.copy()
+        guess.update(pack_proof(proof))
+        return guess.digest() < target
 
 
     # Using classmethod decorator since the verifychain() method does access the class but doesn't 
     # need an instance
     @classmethod
-    def verify_chain(cls, blockchain):
+    def verify_chain(cls, blockchain, checkpoint=None, processes=1, block_time=BLOCK_TIME):
         """ Verify the current blockchain and return True if it's valid,
         false otherwise. 
+
+        Arguments:
+            :blockchain: The blocks to verify.
+            :checkpoint: Optional (height, hash) of a trusted block, e.g. one of our
+            own verified chain. The checkpoint block and the blocks before it are
+            not checked again. A chain without that block is invalid.
+            :processes: Number of worker processes to use, 1 verifies in-process.
+            :block_time: Targeted number of seconds between two blocks (see difficulty.py).
         """
-        for (index, block) in enumerate(blockchain):
-            if index == 0:
-                continue
-            if block.previous_hash != hash_block(blockchain[index - 1]):
-                return False
-            # Excluding reward transactions since the reward transaction is included
-            # after the proof of work
-            if not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
-                print('Proof of work is invalid')
-                return False
-        return True
+        return cls.find_invalid_block(blockchain, checkpoint, processes, block_time) is None
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def find_invalid_block(blockchain, checkpoint=None, processes=1, block_time=BLOCK_TIME, timestamps=None):
+        """ Verifies a chain (see ChainVerifier) and returns the height of its
+        first invalid block, or None if the chain is valid. If the chain doesn't
+        have the checkpoint block, the height of the checkpoint is returned.
+
+        Arguments:
+            :blockchain: The blocks to verify.
+            :checkpoint: Optional (height, hash) of a trusted block (see verify_chain()).
+            :processes: Number of worker processes to use, 1 verifies in-process.
+            :block_time: Targeted number of seconds between two blocks (see difficulty.py).
+            :timestamps: Timestamps of the blocks before the checkpoint, by default
+            they are taken from blockchain. Pass our own if the blocks of blockchain
+            before the checkpoint aren't verified.
+        """
+        height = 0
+        if checkpoint is not None:
+            height, checkpoint_hash = checkpoint
+            try:
+                if height >= len(blockchain) or hash_block(blockchain[height]) != checkpoint_hash:
+                    return height
+            except ValueError:
+                return height
+            if timestamps is None:
+                timestamps = [block.timestamp for block in blockchain[max(height - RETARGET_INTERVAL, 0):height]]
+            # Checking starts at the checkpoint like it starts at the genesis block otherwise
+            blockchain = blockchain[height:]
+        blocks = iter(blockchain)
+        trusted_block = next(blocks, None)
+        if trusted_block is None:
+            return None
+        try:
+            verifier = ChainVerifier(trusted_block, height, processes, timestamps or (), block_time)
+        except ValueError:
+            # The first block of the chain can't even be hashed
+            return height
+        for block in blocks:
+            verifier.add(block)
+        return verifier.get_first_invalid()
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def verify_chains(blockchains, processes=1, checkpoints=None, block_time=BLOCK_TIME, timestamps=None):
+        """ Verify several candidate chains one after the other, each of them
+        spread over the worker processes. Returns a (height of the first invalid
+        block or None, seconds taken) tuple per chain.
+
+        Arguments:
+            :blockchains: The chains that should be verified
+            :processes: Number of worker processes to use, 1 verifies in-process
+            :checkpoints: Optional checkpoint (see verify_chain()) per chain, None
+            entries verify the whole chain
+            :block_time: Targeted number of seconds between two blocks (see difficulty.py)
+            :timestamps: Optional timestamps of the blocks before the checkpoint per
+            chain (see find_invalid_block())
+        """
+        if checkpoints is None:
+            checkpoints = [None] * len(blockchains)
+        if timestamps is None:
+            timestamps = [None] * len(blockchains)
+        results = []
+        for (blockchain, checkpoint, chain_timestamps) in zip(blockchains, checkpoints, timestamps):
+            start = perf_counter()
+            invalid = Verification.find_invalid_block(
+                blockchain, checkpoint, processes, block_time, chain_timestamps)
+            results.append((invalid, perf_counter() - start))
+        return results
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def start_pool(processes):
+        """ Creates the worker pool before it is needed. A process which handles
+        requests in threads should call it before it starts serving them: the
+        workers are forked, if another thread holds a lock at that moment (e.g.
+        the one of the verification cache) the workers inherit it locked.
+
+        Arguments:
+            :processes: Number of worker processes, 1 doesn't need a pool
+        """
+        if processes > 1:
+            _get_verify_pool(processes)
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def valid_fee(fee):
+        """ Checks that a fee is a number which isn't negative, a negative fee
+        would take coins from the miner instead of paying them.
+
+        Arguments:
+            :fee: The fee of a transaction
+        """
+        return _valid_number(fee) and fee >= 0
+
+
+    # Method only working with the inputs its given
+    @staticmethod
+    def valid_amount(amount):
+        """ Checks that an amount is a number greater than 0, a negative amount
+        would take coins from the recipient and increase the balance of the sender.
+
+        Arguments:
+            :amount: The amount of a transaction
+        """
+        return _valid_number(amount) and amount > 0
 
 
     # Method only working with the inputs its given
@@ -64,13 +430,38 @@ class Verification:
         """
         if check_funds:
             sender_balance = get_balance(transaction.sender)
-            return sender_balance >= transaction.amount and Wallet.verify_transaction(transaction)
+            return sender_balance >= transaction.get_total() and Wallet.verify_transaction(transaction)
         else:
             return Wallet.verify_transaction(transaction)
 
 
-    # Method needs access to the class but doesn't need an instance
-    @classmethod
-    def verify_transactions(cls, open_transactions, get_balance):
-        """ Verified all open transactions. """
-        return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
\ No newline at end of file
+    # Method only working with the inputs its given
+    @staticmethod
+    def verify_transactions(transactions, processes=1, legacy=False):
+        """ Verify the signatures of a batch of transactions and return one result
+        per transaction (in the same order).
+
+        Transactions whose result is cached are not verified again, the rest is
+        spread over a pool of worker processes if there are enough of them.
+
+        Arguments:
+            :transactions: The transactions that should be verified
+            :processes: Number of worker processes to use, 1 verifies in-process
+            :legacy: The transactions are part of a block of an older version, which
+            may have been signed the way older versions did (see Wallet.check_signature())
+        """
+        results = [Wallet.cached_verification(tx, legacy) for tx in transactions]
+        unverified = [tx for (tx, result) in zip(transactions, results) if result is None]
+        if processes > 1 and len(unverified) >= PARALLEL_VERIFY_THRESHOLD:
+            chunksize = max(len(unverified) // (processes * 4), 1)
+            checked = _get_verify_pool(processes).map(
+                partial(Wallet.check_signature, legacy=legacy), unverified, chunksize)
+        else:
+            checked = [Wallet.check_signature(tx, legacy) for tx in unverified]
+        checked = iter(checked)
+        for (position, tx) in enumerate(transactions):
+            if results[position] is None:
+                results[position] = next(checked)
+                # Workers have their own caches, remember the result in ours
+                Wallet.remember_verification(tx, results[position], legacy)
+        return results
\ No newline at end of file
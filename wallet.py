@@ -6,12 +6,32 @@ from Crypto.Hash import SHA256
 
 import Crypto.Random
 import binascii
+import json
+import threading
+from collections import OrderedDict
+
+# Number of signature verification results that are remembered
+VERIFICATION_CACHE_SIZE = 10000
+# Number of parsed public keys that are remembered
+PUBLIC_KEY_CACHE_SIZE = 1000
 
 class Wallet:
     """ Create, load, and hold private and public keys. Handles transaction
     signing and verification. 
+
+    Verification results and parsed public keys are cached (least recently used
+    entries are dropped first) since the same transaction gets verified when it
+    is received, when it is mined and when it arrives in a block.
     """
 
+    # Shared by all wallets since verifying doesn't depend on our own keys
+    __verified = OrderedDict()
+    __public_keys = OrderedDict()
+    __cache_hits = 0
+    __cache_misses = 0
+    # The caches are shared by the request threads of the node
+    __cache_lock = threading.Lock()
+
     def __init__(self, node_id):
         self.private_key = None
         self.public_key = None
@@ -74,34 +94,161 @@ class Wallet:
             .decode('ascii')
         )
 
-    def sign_transaction(self, sender, recipient, amount):
+    def sign_transaction(self, sender, recipient, amount, nonce=None, fee=0):
         """ Sign a transaction and return the signature. 
         
         Arguments:
             :sender: The sender of the transaction.
             :recipient: The recipient of the transaction.
             :amount: The amount of the transaction.
+            :nonce: The nonce of the transaction, required by check_signature().
+            :fee: The fee paid to the miner.
         """
         signer = PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(self.private_key)))
         # Create a payload hash converting from string back to binary values
-        h = SHA256.new((str(sender) + str(recipient) + str(amount)).encode('utf8'))
+        h = SHA256.new(Wallet.__payload(sender, recipient, amount, nonce, fee))
         # Generate a signature using our hash payload
         signature = signer.sign(h)
         # Return signature as a string
         return binascii.hexlify(signature).decode('ascii')
 
-    # Set to static method since we never access the class
-    @staticmethod
-    def verify_transaction(transaction):
+    # Set to class method since we access the caches of the class
+    @classmethod
+    def verify_transaction(cls, transaction, legacy=False):
         """Verify the signature of a transaction.
 
         Arguments:
             :transaction: The transaction that should be verified.
+            :legacy: Also accept the payload of older versions (see check_signature()).
         """
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
+        result = cls.cached_verification(transaction, legacy)
+        if result is None:
+            result = cls.check_signature(transaction, legacy)
+            cls.remember_verification(transaction, result, legacy)
+        return result
+
+    @classmethod
+    def check_signature(cls, transaction, legacy=False):
+        """ Runs the actual RSA verification of a transaction without looking
+        at the result cache.
+
+        Arguments:
+            :transaction: The transaction that should be verified.
+            :legacy: Also accept the ambiguous payload older versions signed, only
+            for transactions of blocks mined by older versions. New transactions
+            need a nonce.
+        """
+        try:
+            return cls.__check_signature(transaction, legacy)
+        except (ValueError, TypeError):
+            # A sender or signature which isn't hex (or not even a string) came from a peer
+            return False
+
+    @classmethod
+    def __check_signature(cls, transaction, legacy):
+        payloads = []
+        if transaction.nonce is not None:
+            payloads.append(Wallet.__payload(
+                transaction.sender, transaction.recipient, transaction.amount, transaction.nonce, transaction.fee))
+        if legacy:
+            payloads.append(Wallet.__legacy_payload(
+                transaction.sender, transaction.recipient, transaction.amount, transaction.nonce, transaction.fee))
+        verifier = PKCS1_v1_5.new(cls.__public_key(transaction.sender))
+        signature = binascii.unhexlify(transaction.signature)
         # Create a payload hash converting from string back to binary values
-        h = SHA256.new((str(transaction.sender) + str(transaction.recipient) + 
-                        str(transaction.amount)).encode('utf8'))
-        # Return binary version of verification
-        return verifier.verify(h, binascii.unhexlify(transaction.signature))
\ No newline at end of file
+        return any(verifier.verify(SHA256.new(payload), signature) for payload in payloads)
+
+    @classmethod
+    def cached_verification(cls, transaction, legacy=False):
+        """ Returns the remembered verification result of a transaction or None
+        if it wasn't verified yet.
+        """
+        key = cls.__cache_key(transaction, legacy)
+        with cls.__cache_lock:
+            # Fields which can't be hashed are never cached (and never valid)
+            if not cls.__hashable(key):
+                return None
+            if key in cls.__verified:
+                cls.__cache_hits += 1
+                cls.__verified.move_to_end(key)
+                return cls.__verified[key]
+            cls.__cache_misses += 1
+            return None
+
+    @classmethod
+    def remember_verification(cls, transaction, result, legacy=False):
+        """ Stores the verification result of a transaction in the cache. """
+        key = cls.__cache_key(transaction, legacy)
+        if not cls.__hashable(key):
+            return
+        with cls.__cache_lock:
+            cls.__verified[key] = result
+            if len(cls.__verified) > VERIFICATION_CACHE_SIZE:
+                cls.__verified.popitem(last=False)
+
+    @staticmethod
+    def __cache_key(transaction, legacy):
+        # The amount is part of the key as string since that's what was signed (1 and 1.0 differ)
+        return (transaction.sender, transaction.recipient, str(transaction.amount),
+                transaction.nonce, str(transaction.fee), transaction.signature, legacy)
+
+    @staticmethod
+    def __hashable(key):
+        try:
+            hash(key)
+            return True
+        except TypeError:
+            return False
+
+    @staticmethod
+    def __payload(sender, recipient, amount, nonce, fee):
+        """ Returns the bytes which are signed for a transaction. Every field is
+        encoded on its own, so text can't be moved from one field into another
+        without changing the payload.
+        """
+        return json.dumps({
+            'sender': sender,
+            'recipient': recipient,
+            'amount': amount,
+            'nonce': nonce,
+            'fee': fee
+        }, sort_keys=True).encode('utf8')
+
+    @staticmethod
+    def __legacy_payload(sender, recipient, amount, nonce, fee):
+        """ Returns the bytes older versions signed, the fields are simply
+        glued together (amount 5 with nonce '3a' is the same as 53 with 'a').
+        """
+        payload = str(sender) + str(recipient) + str(amount)
+        # Transactions of older versions have no nonce
+        if nonce is not None:
+            payload += str(nonce)
+        # The fee is signed so nobody can change it, transactions without a fee keep the old payload
+        if fee:
+            payload += 'fee' + str(fee)
+        return payload.encode('utf8')
+
+    @classmethod
+    def __public_key(cls, sender):
+        """ Returns the parsed RSA key of a sender, importing it only once. """
+        with cls.__cache_lock:
+            if sender in cls.__public_keys:
+                cls.__public_keys.move_to_end(sender)
+                return cls.__public_keys[sender]
+        # Parsing the key happens outside the lock, two threads might both parse it
+        public_key = RSA.importKey(binascii.unhexlify(sender))
+        with cls.__cache_lock:
+            cls.__public_keys[sender] = public_key
+            if len(cls.__public_keys) > PUBLIC_KEY_CACHE_SIZE:
+                cls.__public_keys.popitem(last=False)
+        return public_key
+
+    @classmethod
+    def verification_cache_info(cls):
+        """ Returns hit/miss counters and the size of the verification caches. """
+        return {
+            'hits': cls.__cache_hits,
+            'misses': cls.__cache_misses,
+            'verified': len(cls.__verified),
+            'public_keys': len(cls.__public_keys)
+        }
\ No newline at end of file